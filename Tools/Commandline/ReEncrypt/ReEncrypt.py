@@ -22,158 +22,438 @@ import sys, getopt
 import io
 import json
 import zipfile
+import struct
+import copy
 import base64
 import hashlib
 import pyAesCrypt
 from collections import OrderedDict
-from tempfile import mkstemp, mkdtemp, TemporaryFile, TemporaryDirectory, NamedTemporaryFile
+from tempfile import SpooledTemporaryFile, TemporaryDirectory
 import gnupg
 import shutil
-from joblib import Parallel, delayed
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import multiprocessing
+from contextlib import contextmanager
+
+# size of the pieces read, decrypted, encrypted and written
+bufferSize = 1024 * 1024
+# a dindex is rewritten in memory up to this size, larger ones go through temp files
+spoolSize = 64 * 1024 * 1024
 
 def mainReEncrypt(options):
+    # every dlist and dblock is a task of its own, the largest first so that no
+    # worker is left with a big one at the end. a dindex is rewritten as soon as
+    # all of its dblocks are done. cpu_jobs caps the volumes being decrypted and
+    # encrypted at the same time, io_jobs the reads and writes of pieces of them.
+    # the crypto libraries, gpg and hashlib release the GIL, so threads are enough.
+    cpu_jobs = options.get('cpu_jobs') or multiprocessing.cpu_count()
+    io_slots = threading.BoundedSemaphore(options.get('io_jobs') or 4)
+    orig_path = options['orig']['path']
+
     # locate dlist
-    dlists = [name for name in os.listdir(options['orig']['path']) if name.endswith(".dlist.%s" %(options['orig']['extension']))]
-
-    # loop over all dlists; they only need to be enencrypted, and encrypted. They have no relation to the dindex and dblock files.
-    with NamedTemporaryFile() as temp_file:
-        for dlist_enc in dlists:
-            dlist_enc_fullpath = os.path.join(options['orig']['path'],dlist_enc)
-            dlist_reenc_fullpath = os.path.join(options['new']['path'],change_ext(dlist_enc,options['orig']['extension'],options['new']['extension']))
-            decrypt(options['orig'],dlist_enc_fullpath,options['orig']['passwd'],temp_file.name)
-            encrypt(options['new'],temp_file.name,options['new']['passwd'], dlist_reenc_fullpath)
-    
-    # locate dlist
-    dindex = [name for name in os.listdir(options['orig']['path']) if name.endswith(".dindex.%s" %(options['orig']['extension']))]
-
-    num_cores = multiprocessing.cpu_count()
-    Parallel(n_jobs=num_cores*2)(delayed(handleIndex)(options, dindex_enc) for dindex_enc in dindex)
-
-def handleIndex(options, dindex_enc):
-    with NamedTemporaryFile() as temp_dindex, NamedTemporaryFile() as temp_dindex_reenc, TemporaryDirectory() as temp_path_zip:
-        dindex_enc_fullpath = os.path.join(options['orig']['path'],dindex_enc)
-        dindex_reenc_fullpath = os.path.join(options['new']['path'],change_ext(dindex_enc,options['orig']['extension'],options['new']['extension']))
-        
-        decrypt(options['orig'],dindex_enc_fullpath,options['orig']['passwd'],temp_dindex.name)
-            
-        unzip(temp_dindex,temp_path_zip)
-
-        vol_path = os.path.join(temp_path_zip,'vol')
-        if os.path.exists(vol_path):    
-            for dblock in os.listdir(vol_path):
-                data = []
-                with open(os.path.join(vol_path, dblock)) as data_file:
-                    data = json.load(data_file, object_pairs_hook=OrderedDict)
+    dlists = [name for name in os.listdir(orig_path) if name.endswith(".dlist.%s" %(options['orig']['extension']))]
+
+    # locate dindex
+    dindex = [name for name in os.listdir(orig_path) if name.endswith(".dindex.%s" %(options['orig']['extension']))]
+
+    # fails on an unknown encryption before anything is written
+    get_cipher(options['orig'])
+    get_cipher(options['new'])
+
+    progress = ProgressManifest(options.get('progress_file') or os.path.join(options['new']['path'], 'ReEncrypt-progress.json'))
+
+    # every dindex is decrypted once, to find its dblocks, and its plaintext is kept
+    # in plain_path until it is rewritten. on disk, as that can take until the last dblock.
+    with ThreadPoolExecutor(cpu_jobs) as executor, progress, TemporaryDirectory(prefix='ReEncrypt-', dir=options.get('temp_path')) as plain_path:
+        def plaintext_of(dindex_enc):
+            return os.path.join(plain_path, dindex_enc)
+        # the dblocks listed in every dindex, and the hash and size of the dindex
+        indexed = dict(zip(dindex, executor.map(lambda dindex_enc: index_volumes(options, dindex_enc, plaintext_of(dindex_enc), io_slots), dindex)))
+        waiting = dict((dindex_enc, set(dblocks)) for dindex_enc, (dblocks, source) in indexed.items())
+        volumes_of = dict((dindex_enc, set(dblocks)) for dindex_enc, dblocks in waiting.items())
+        indexes_of = {}
+        for dindex_enc, dblocks in waiting.items():
+            for dblock in dblocks:
+                indexes_of.setdefault(dblock, []).append(dindex_enc)
+
+        # dlists only need to be decrypted, and encrypted. They have no relation to the dindex and dblock files.
+        volumes = sorted(dlists + list(indexes_of), key=lambda name: -os.path.getsize(os.path.join(orig_path, name)))
+
+        # volumes finished by an earlier run are skipped. a dindex is rewritten again
+        # when it was not finished, or when it was written with other hashes of its
+        # dblocks than their current ones, as a dblock transcoded again gets a new hash.
+        transcoded = {}
+        def written_with(dindex_enc):
+            return dict((dblock, transcoded[dblock][2].decode('utf8')) for dblock in volumes_of[dindex_enc])
+
+        for name in list(volumes):
+            entry = progress.complete(options, name)
+            if entry:
+                print('skipping: %s, done in an earlier run' % name)
+                transcoded[name] = progress.result(entry)
+                volumes.remove(name)
+        for dindex_enc, dblocks in list(waiting.items()):
+            dblocks.difference_update(transcoded)
+            entry = progress.complete(options, dindex_enc)
+            if not dblocks and entry and entry.get('dblocks') == written_with(dindex_enc):
+                print('skipping: %s, done in an earlier run' % dindex_enc)
+                del waiting[dindex_enc]
+                os.remove(plaintext_of(dindex_enc))
+
+        def rewrite(dindex_enc):
+            return executor.submit(handleIndex, options, dindex_enc, plaintext_of(dindex_enc), indexed[dindex_enc][1], transcoded, io_slots)
+
+        running = {}
+        for name in volumes:
+            running[executor.submit(transcode, options, os.path.join(orig_path, name),
+                os.path.join(options['new']['path'], change_ext(name, options['orig']['extension'], options['new']['extension'])),
+                io_slots)] = name
+        for dindex_enc in [name for name, dblocks in waiting.items() if not dblocks]:
+            running[rewrite(dindex_enc)] = dindex_enc
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception():
+                    # do not start the remaining tasks
+                    for other in running:
+                        other.cancel()
+                    raise future.exception()
+                result = future.result()
+                progress.add(options, name, result, written_with(name) if name in volumes_of else None)
+                if name not in indexes_of:
+                    continue
+                transcoded[name] = result
+                for dindex_enc in indexes_of[name]:
+                    waiting[dindex_enc].discard(name)
+                    if not waiting[dindex_enc]:
+                        running[rewrite(dindex_enc)] = dindex_enc
+
+class ProgressManifest(object):
+    # the volumes completed so far, one json object per line, appended and synced
+    # to disk as each one is done. a volume counts as done on a later run when its
+    # source still has the same size and mtime and its output the size written.
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        line = '\n'
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line of a run that was cut off
+                        continue
+                    self.done[entry['name']] = entry
+        self.f = open(path, 'a')
+        if not line.endswith('\n'):
+            self.f.write('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.f.close()
+
+    def complete(self, options, name):
+        # the entry of name, if it is done and its output is still there
+        entry = self.done.get(name)
+        if entry is None:
+            return None
+        try:
+            source = os.stat(os.path.join(options['orig']['path'], name))
+            output = os.stat(os.path.join(options['new']['path'], entry['new_name']))
+        except OSError:
+            return None
+        if (source.st_size, int(source.st_mtime)) != (entry['size'], entry['mtime']) or output.st_size != entry['new_size']:
+            return None
+        return entry
+
+    def add(self, options, name, result, dblocks=None):
+        # result is what transcode and handleIndex return. for a dindex, dblocks
+        # has the new hash of each of its dblocks it was written with
+        source_hash, size, new_hash, new_size = result
+        mtime = int(os.path.getmtime(os.path.join(options['orig']['path'], name)))
+        entry = OrderedDict([('name', name), ('hash', source_hash.decode('utf8')), ('size', size), ('mtime', mtime),
+            ('new_name', change_ext(name, options['orig']['extension'], options['new']['extension'])),
+            ('new_hash', new_hash.decode('utf8')), ('new_size', new_size)])
+        if dblocks is not None:
+            entry['dblocks'] = dblocks
+        self.f.write(json.dumps(entry) + '\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.done[name] = entry
+
+    @staticmethod
+    def result(entry):
+        return entry['hash'].encode('utf8'), entry['size'], entry['new_hash'].encode('utf8'), entry['new_size']
+
+def index_volumes(options, dindex_enc, plaintext_path, io_slots=None):
+    # decrypts a dindex to plaintext_path for handleIndex. returns the names of the
+    # dblocks it describes, and the hash and size of the dindex.
+    with open(os.path.join(options['orig']['path'], dindex_enc), 'rb') as f, open(plaintext_path, 'wb') as plaintext:
+        source = HashingFile(f, io_slots)
+        decrypt_stream(options['orig'], source, options['orig']['passwd'], plaintext)
+    with zipfile.ZipFile(plaintext_path) as zf:
+        names = [name[len('vol/'):] for name in zf.namelist() if name.startswith('vol/') and name != 'vol/']
+    return names, (source.digest(), source.size)
+
+def handleIndex(options, dindex_enc, plaintext_path, source, transcoded, io_slots=None):
+    # plaintext_path and source are what index_volumes wrote and returned for the dindex,
+    # transcoded has the result of transcode for each dblock of it.
+    # returns the hash and size of the old and of the new dindex, like transcode.
+    # the zip is rewritten member by member: the vol/ entries get the new hash and
+    # size, everything else, like the blocklists in list/, is copied still compressed.
+    dindex_enc_fullpath = os.path.join(options['orig']['path'],dindex_enc)
+    dindex_reenc_fullpath = os.path.join(options['new']['path'],change_ext(dindex_enc,options['orig']['extension'],options['new']['extension']))
+    print('rewriting: %s to %s' % (dindex_enc_fullpath, dindex_reenc_fullpath))
+
+    with SpooledTemporaryFile(spoolSize) as rewritten:
+        with zipfile.ZipFile(plaintext_path) as zin, zipfile.ZipFile(rewritten, 'w', zipfile.ZIP_DEFLATED) as zout:
+            for info in zin.infolist():
+                if not info.filename.startswith('vol/') or info.is_dir():
+                    copy_zip_member(zin, zout, info, info.filename)
+                    continue
+
+                dblock = info.filename[len('vol/'):]
+                new_name = 'vol/' + change_ext(dblock,options['orig']['extension'],options['new']['extension'])
+                data = json.loads(zin.read(info).decode('utf8'), object_pairs_hook=OrderedDict)
 
                 expected_hash = data['volumehash'].encode('utf8')
                 expected_volumesize = data['volumesize']
 
+                # the old and the new volume were hashed while they were transcoded
+                actual_hash, actual_volumesize, new_hash, new_volumesize = transcoded[dblock]
+
                 if (options['verify_hash']):
-                    actual_hash = computeHash(os.path.join(options['orig']['path'],dblock))
-                    actual_volumesize=os.stat(os.path.join(options['orig']['path'],dblock)).st_size
                     print('dblock: %s expected_hash: %s calc_hash: %s exact: %s' % (dblock,expected_hash.decode('utf8'),actual_hash.decode('utf8'),expected_hash==actual_hash))
 
-                with NamedTemporaryFile() as temp_dblock:
-                    dblock_enc_fullpath = os.path.join(options['orig']['path'],dblock)
-                    dblock_reenc_fullpath = os.path.join(options['new']['path'],change_ext(dblock,options['orig']['extension'],options['new']['extension']))
-                    decrypt(options['orig'],dblock_enc_fullpath,options['orig']['passwd'],temp_dblock.name)
-                    encrypt(options['new'],temp_dblock.name,options['new']['passwd'], dblock_reenc_fullpath)
-                    new_hash = computeHash(dblock_reenc_fullpath)
-                    
+                print('dblock: %s old_hash: %s new_hash: %s' % (dblock,expected_hash.decode('utf8'),new_hash.decode('utf8')))
+                if (expected_hash, expected_volumesize) == (new_hash, new_volumesize):
+                    copy_zip_member(zin, zout, info, new_name)
+                    continue
                 data['volumehash'] = new_hash.decode('utf8')
-                data['volumesize'] = os.stat(os.path.join(options['new']['path'],change_ext(dblock,options['orig']['extension'],options['new']['extension']))).st_size
-                print('dblock: %s old_hash: %s new_hash: %s' % (dblock,expected_hash.decode('utf8'),data['volumehash']))
+                data['volumesize'] = new_volumesize
+                zout.writestr(zipfile.ZipInfo(new_name, info.date_time), json.dumps(data), zipfile.ZIP_DEFLATED)
+
+        rewritten.seek(0)
+        with atomic_output(dindex_reenc_fullpath) as out:
+            destination = HashingFile(out, io_slots)
+            encrypt_stream(options['new'], rewritten, options['new']['passwd'], destination)
+    os.remove(plaintext_path)
+    return source[0], source[1], destination.digest(), destination.size
+
+def copy_zip_member(zin, zout, info, name):
+    # copies a member of zin to zout under name as its raw compressed bytes,
+    # zipfile has no public way to do this without inflating and deflating it
+    zin.fp.seek(info.header_offset)
+    header = zin.fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    zin.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+    data = zin.fp.read(info.compress_size)
 
-                with open(os.path.join(vol_path,dblock),'w') as data_file:
-                    json.dump(data, data_file)
+    copied = copy.copy(info)
+    copied.filename = copied.orig_filename = name
+    # crc and sizes go into the local header, there is no data descriptor after the data
+    copied.flag_bits &= ~0x08
+    zout.fp.seek(zout.start_dir)
+    copied.header_offset = zout.fp.tell()
+    zout.fp.write(copied.FileHeader())
+    zout.fp.write(data)
+    zout.start_dir = zout.fp.tell()
+    zout.filelist.append(copied)
+    zout.NameToInfo[name] = copied
+    zout._didModify = True
 
-                os.rename(os.path.join(vol_path, dblock), os.path.join(vol_path, change_ext(dblock,options['orig']['extension'],options['new']['extension']))) 
-        
-        make_zipfile(temp_dindex_reenc.name,temp_path_zip)
-        encrypt(options['new'],temp_dindex_reenc.name, options['new']['passwd'],dindex_reenc_fullpath)
+def transcode(options, encrypted, reencrypted, io_slots=None):
+    # decrypt with the orig settings and encrypt with the new ones in one pass,
+    # without temporary files. the plaintext goes through a pipe from a decrypting
+    # thread to the encryption, so only a few buffers are in memory.
+    # returns the hash and size of the old and of the new file.
+    print('transcoding: %s to %s' % (encrypted, reencrypted))
+    read_pipe, write_pipe = os.pipe()
+    plaintext_in, plaintext_out = open(read_pipe, 'rb'), open(write_pipe, 'wb')
+    errors = []
+
+    def decrypt_to_pipe(source):
+        try:
+            with plaintext_out:
+                decrypt_stream(options['orig'], source, options['orig']['passwd'], plaintext_out)
+        except BaseException as e:
+            errors.append(e)
+
+    try:
+        with open(encrypted, 'rb') as f, atomic_output(reencrypted) as out:
+            source = HashingFile(f, io_slots)
+            destination = HashingFile(out, io_slots)
+            thread = threading.Thread(target=decrypt_to_pipe, args=(source,))
+            thread.start()
+            try:
+                with plaintext_in:
+                    encrypt_stream(options['new'], plaintext_in, options['new']['passwd'], destination)
+            finally:
+                # when encrypting failed, the decrypting thread stops on the closed pipe
+                thread.join()
+            # raised in here, so that the output of a failed or unverified decrypt
+            # is removed and never renamed to the real name
+            if errors:
+                raise errors[0]
+    finally:
+        # both are closed already, unless opening the files failed
+        plaintext_in.close()
+        plaintext_out.close()
+    return source.digest(), source.size, destination.digest(), destination.size
+
+class HashingFile(object):
+    # wraps a file, hashing and counting the bytes read from or written to it.
+    # each read and write holds one of io_slots, if given.
+    def __init__(self, f, io_slots=None):
+        self.f = f
+        self.io_slots = io_slots
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        if self.io_slots:
+            with self.io_slots:
+                data = self.f.read(size)
+        else:
+            data = self.f.read(size)
+        self.hasher.update(data)
+        self.size += len(data)
+        return data
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        if self.io_slots:
+            with self.io_slots:
+                return self.f.write(data)
+        return self.f.write(data)
+
+    def digest(self):
+        return base64.b64encode(self.hasher.digest())
+
+def decrypt_stream(options, encrypted, passw, decrypted):
+    # encrypted and decrypted are file objects
+    get_cipher(options).decrypt(encrypted, passw, decrypted)
+
+def encrypt_stream(options, decrypted, passw, encrypted):
+    # decrypted and encrypted are file objects
+    get_cipher(options).encrypt(decrypted, passw, encrypted)
+
+class Cipher(object):
+    # an encryption backend, for one of the 'encryption' values of the config.
+    # decrypt and encrypt copy from one file object to the other. one instance is
+    # made for the orig and one for the new settings and used by all threads, so
+    # anything slow to set up is set up once instead of for every volume.
+    def __init__(self, options):
+        self.options = options
+        self.buffer_size = options.get('buffer_size') or bufferSize
+
+    def decrypt(self, encrypted, passw, decrypted):
+        raise NotImplementedError
+
+    def encrypt(self, decrypted, passw, encrypted):
+        raise NotImplementedError
+
+class AesCipher(Cipher):
+    # buffer_size has to be a multiple of 16
+    def decrypt(self, encrypted, passw, decrypted):
+        pyAesCrypt.decryptStream(encrypted, decrypted, passw, self.buffer_size)
+
+    def encrypt(self, decrypted, passw, encrypted):
+        pyAesCrypt.encryptStream(decrypted, encrypted, passw, self.buffer_size)
+
+class GpgCipher(Cipher):
+    # python-gnupg runs gpg for every operation, but making a gnupg.GPG runs it
+    # too, to check the version. the GPG objects are kept and reused, each by one
+    # operation at a time because on_data is set on them.
+    def __init__(self, options):
+        Cipher.__init__(self, options)
+        self.idle = queue.LifoQueue()
+
+    @contextmanager
+    def session(self, output):
+        try:
+            gpg = self.idle.get_nowait()
+        except queue.Empty:
+            gpg = gnupg.GPG()
+            gpg.buffer_size = self.buffer_size
+        gpg.on_data = write_gpg_output(output)
+        try:
+            yield gpg
+        finally:
+            gpg.on_data = None
+            self.idle.put(gpg)
+
+    def decrypt(self, encrypted, passw, decrypted):
+        with self.session(decrypted) as gpg:
+            status = gpg.decrypt_file(encrypted, passphrase=passw)
+        check_gpg_status(status, 'decrypt')
+
+    def encrypt(self, decrypted, passw, encrypted):
+        with self.session(encrypted) as gpg:
+            status = gpg.encrypt_file(decrypted, recipients=self.options['recipients'], armor=False)
+        check_gpg_status(status, 'encrypt')
+
+class NoCipher(Cipher):
+    def decrypt(self, encrypted, passw, decrypted):
+        shutil.copyfileobj(encrypted, decrypted, self.buffer_size)
+
+    def encrypt(self, decrypted, passw, encrypted):
+        shutil.copyfileobj(decrypted, encrypted, self.buffer_size)
+
+# the backends by the 'encryption' value of the config, add an entry for another one
+ciphers = {'aes': AesCipher, 'gpg': GpgCipher, 'none': NoCipher}
+cipher_instances = {}
+cipher_lock = threading.Lock()
+
+def get_cipher(options):
+    # the backend for the orig or the new settings, made on first use
+    with cipher_lock:
+        instance = cipher_instances.get(id(options))
+        if instance is None or instance.options is not options:
+            if options['encryption'] not in ciphers:
+                raise Exception('unknown encryption: %s' % options['encryption'])
+            instance = cipher_instances[id(options)] = ciphers[options['encryption']](options)
+        return instance
+
+def write_gpg_output(f):
+    # writes the output of gpg to f as it comes, instead of collecting it in memory
+    def on_data(data):
+        f.write(data)
+        return False
+    return on_data
+
+def check_gpg_status(status, action):
+    if not status.ok:
+        raise Exception('gpg could not %s: %s' % (action, status.status))
+    if getattr(status, 'on_data_failure', None):
+        raise status.on_data_failure
 
 def change_ext(filename, ext_old, ext_new):
     return filename.replace(ext_old, ext_new)
 
-def decrypt(options, encrypted, passw, decrypted):
-    print('decrypting: %s to %s' % (encrypted, decrypted))
-    if options['encryption']=='aes':
-        bufferSize = 64 * 1024
-        pyAesCrypt.decryptFile(encrypted, decrypted, passw, bufferSize)
-    if options['encryption']=='gpg':
-        gpg = gnupg.GPG()
-        with open(encrypted, 'rb') as f:
-            status  = gpg.decrypt_file(f, output=decrypted,passphrase=passw)
-    if options['encryption']=='none':
-        shutil.copy(encrypted,decrypted)
-    
-
-def encrypt(options,decrypted, passw, encrypted):
-    print('encrypting: %s %s' % (decrypted, encrypted))
-    if options['encryption']=='aes':
-        bufferSize = 64 * 1024
-        pyAesCrypt.encryptFile(decrypted, encrypted, passw, bufferSize)
-    if options['encryption']=='gpg':
-        gpg = gnupg.GPG()
-        with open(decrypted, 'rb') as f:
-            status  = gpg.encrypt_file(f, recipients=options['recipients'], output=encrypted, armor=False)
-    if options['encryption']=='none':
-        shutil.copy(decrypted,encrypted)
-
-def emptydir(top):
-    if(top == '/' or top == "\\"): return
-    else:
-        for root, dirs, files in os.walk(top, topdown=False):
-            for name in files:
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
-
-def unzip(archive, path):
-    emptydir(path)
-    with zipfile.ZipFile(archive.name) as zf:
-        zf.extractall(path)
-
-def make_zipfile(output_filename, source_dir):
-    print('zipping: %s to %s' % (source_dir, output_filename))
-    emptydir(output_filename)
-    relroot=source_dir
-    with zipfile.ZipFile(output_filename, "w", zipfile.ZIP_DEFLATED) as zip:
-        for root, dirs, files in os.walk(source_dir):
-            # add directory (needed for empty dirs)
-            zip.write(root, os.path.relpath(root, relroot))
-            for file in files:
-                filename = os.path.join(root, file)
-                if os.path.isfile(filename): # regular files only
-                    arcname = os.path.join(os.path.relpath(root, relroot), file)
-                    zip.write(filename, arcname)
-                    
-
-def rezip(temp_path_z, path):
-    zf = zipfile.ZipFile(path, "w")
-    for dirname, subdirs, files in os.walk(temp_path_z):
-        zf.write(dirname)
-        for filename in files:
-            zf.write(os.path.join(dirname, filename))
-    zf.close()
-
-def zipdir(path,ziph):
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            ziph.write(os.path.join(root, file))
-            
-def computeHash(path):
-    print('hashing: %s ' % (path))
-    buffersize=64 * 1024
-    hasher = hashlib.sha256()
-    with open(path, 'rb') as f:
-        while True:
-            buffer = f.read(buffersize)
-            if not buffer:
-                break
-            hasher.update(buffer)
-    return base64.b64encode(hasher.digest())
+@contextmanager
+def atomic_output(path):
+    # writes to path.part and renames it to path once it is complete and on disk,
+    # so an interrupted run never leaves a truncated volume under its real name
+    part = path + '.part'
+    try:
+        with open(part, 'wb') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(part, path)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
 
 def main(argv):
     configfile = ''
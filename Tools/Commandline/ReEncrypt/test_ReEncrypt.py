@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# run with: python3 -m unittest test_ReEncrypt
+
+import io
+import json
+import os
+import shutil
+import unittest
+import zipfile
+from unittest import mock
+from tempfile import TemporaryDirectory
+
+import pyAesCrypt
+
+import ReEncrypt
+
+class TranscodeFailureTest(unittest.TestCase):
+    # a volume that cannot be decrypted must not leave any output behind
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.encrypted = os.path.join(self.tmp.name, 'volume.zip.aes')
+        self.reencrypted = os.path.join(self.tmp.name, 'volume.zip')
+        plain = os.path.join(self.tmp.name, 'plain')
+        with open(plain, 'wb') as f:
+            f.write(os.urandom(3 * ReEncrypt.bufferSize + 123))
+        pyAesCrypt.encryptFile(plain, self.encrypted, 'pw', 64 * 1024)
+
+    def transcode(self, passwd):
+        options = {'orig': {'encryption': 'aes', 'passwd': passwd}, 'new': {'encryption': 'none', 'passwd': None}}
+        return ReEncrypt.transcode(options, self.encrypted, self.reencrypted)
+
+    def assertNoOutput(self):
+        self.assertFalse(os.path.exists(self.reencrypted))
+        self.assertFalse(os.path.exists(self.reencrypted + '.part'))
+
+    def test_wrong_password(self):
+        with self.assertRaises(ValueError):
+            self.transcode('wrong')
+        self.assertNoOutput()
+
+    def test_corrupted_hmac(self):
+        with open(self.encrypted, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 1]))
+        with self.assertRaises(ValueError):
+            self.transcode('pw')
+        self.assertNoOutput()
+
+    def test_missing_source_closes_pipe(self):
+        os.remove(self.encrypted)
+        fds = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None
+        with self.assertRaises(FileNotFoundError):
+            self.transcode('pw')
+        self.assertNoOutput()
+        if fds is not None:
+            self.assertEqual(fds, len(os.listdir('/proc/self/fd')))
+
+    def test_success(self):
+        size = self.transcode('pw')[3]
+        self.assertEqual(os.path.getsize(self.reencrypted), size)
+        self.assertFalse(os.path.exists(self.reencrypted + '.part'))
+
+class ResumeTest(unittest.TestCase):
+    # aes to aes, where a volume encrypted again keeps its size but not its hash
+    def setUp(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.orig = os.path.join(tmp.name, 'orig')
+        self.new = os.path.join(tmp.name, 'new')
+        os.mkdir(self.orig)
+        os.mkdir(self.new)
+        self.options = {'orig': {'extension': 'zip.aes', 'path': self.orig, 'passwd': 'pw', 'encryption': 'aes'},
+            'new': {'extension': 'zip.aes', 'path': self.new, 'passwd': 'pw2', 'encryption': 'aes'},
+            'verify_hash': False, 'cpu_jobs': 2}
+        self.dblocks = ['duplicati-b%02d.dblock.zip.aes' % i for i in range(3)]
+        for i, dblock in enumerate(self.dblocks):
+            self.write_encrypted(self.orig, dblock, 'pw', self.zip({'manifest': '{}', 'block': os.urandom(5000)}))
+            self.write_encrypted(self.orig, 'duplicati-i%02d.dindex.zip.aes' % i, 'pw', self.zip({'manifest': '{}',
+                'vol/' + dblock: json.dumps({'blocks': [], 'volumehash': 'x', 'volumesize': 0})}))
+
+    def zip(self, members):
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, 'w') as z:
+            for name, content in members.items():
+                z.writestr(name, content)
+        return data.getvalue()
+
+    def write_encrypted(self, path, name, passwd, data):
+        with open(os.path.join(path, name), 'wb') as f:
+            pyAesCrypt.encryptStream(io.BytesIO(data), f, passwd, 64 * 1024)
+
+    def run_reencrypt(self):
+        with mock.patch('sys.stdout', io.StringIO()) as out:
+            ReEncrypt.mainReEncrypt(self.options)
+        return [line for line in out.getvalue().splitlines() if line.startswith(('transcoding', 'rewriting'))]
+
+    def assertIndexesMatch(self):
+        for i, dblock in enumerate(self.dblocks):
+            plain = io.BytesIO()
+            with open(os.path.join(self.new, 'duplicati-i%02d.dindex.zip.aes' % i), 'rb') as f:
+                pyAesCrypt.decryptStream(f, plain, 'pw2', 64 * 1024)
+            with zipfile.ZipFile(plain) as z:
+                vol = json.loads(z.read('vol/' + dblock).decode('utf8'))
+            with open(os.path.join(self.new, dblock), 'rb') as f:
+                source = ReEncrypt.HashingFile(f)
+                while source.read(ReEncrypt.bufferSize):
+                    pass
+            self.assertEqual(vol['volumehash'], source.digest().decode('utf8'), dblock)
+            self.assertEqual(vol['volumesize'], source.size, dblock)
+
+    def test_rerun_skips_everything(self):
+        self.assertEqual(6, len(self.run_reencrypt()))
+        self.assertEqual([], self.run_reencrypt())
+        self.assertIndexesMatch()
+
+    def test_every_file_decrypted_once(self):
+        decrypt_stream = ReEncrypt.decrypt_stream
+        with mock.patch.object(ReEncrypt, 'decrypt_stream', side_effect=decrypt_stream) as decrypt:
+            self.run_reencrypt()
+        self.assertEqual(6, decrypt.call_count)
+        self.assertIndexesMatch()
+
+    def test_dindex_rewritten_after_its_dblock(self):
+        # run 2 transcodes b01 again and stops before i01 is recorded, leaving
+        # the i01 of run 1 with the old hash of b01 and its entry of run 1
+        self.run_reencrypt()
+        index = os.path.join(self.new, 'duplicati-i01.dindex.zip.aes')
+        shutil.copy(index, os.path.join(self.tmp, 'i01'))
+        os.remove(os.path.join(self.new, self.dblocks[1]))
+        self.run_reencrypt()
+        progress = os.path.join(self.new, 'ReEncrypt-progress.json')
+        with open(progress) as f:
+            lines = f.read().splitlines()
+        del lines[max(i for i, line in enumerate(lines) if json.loads(line)['name'] == 'duplicati-i01.dindex.zip.aes')]
+        with open(progress, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        shutil.copy(os.path.join(self.tmp, 'i01'), index)
+
+        self.assertEqual(['rewriting'], [line.split(':')[0] for line in self.run_reencrypt()])
+        self.assertIndexesMatch()
+
+if __name__ == '__main__':
+    unittest.main()
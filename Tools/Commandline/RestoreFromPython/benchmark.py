@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# microbenchmarks for restore_from_python, run with --help for the list.
+# numbers are printed per operation, compare runs on the same machine only.
+
+import argparse
+import os
+import time
+import tempfile
+
+def timeit(label, fn, repeat):
+    t = time.perf_counter()
+    for i in range(repeat):
+        fn(i)
+    elapsed = time.perf_counter() - t
+    print('%-40s %10.3f ms/op  (%d ops)' % (label, elapsed * 1000 / repeat, repeat))
+    return elapsed
+
+def legacyStretch(passw, iv1):
+    # pyAesCryptStretch before the hashlib/caching changes
+    from Crypto.Hash import SHA256
+    digest=iv1+(16*b"\x00")
+    for _ in range(8192):
+        passHash=SHA256.new()
+        passHash.update(digest)
+        passHash.update(bytes(passw,"utf_16_le"))
+        digest=passHash.digest()
+    return digest
+
+def benchAesHeader(args):
+    # per-volume overhead of opening an .aes file: stretching the key and
+    # checking the header HMAC, without decrypting the content
+    from pyaescrypt import AesCryptReader, pyAesCryptStretch
+    ivs = [os.urandom(16) for _ in range(args.volumes)]
+    assert legacyStretch('password', ivs[0]) == pyAesCryptStretch('password', ivs[0])
+    timeit('stretch, legacy (Crypto.Hash)', lambda i: legacyStretch('password', ivs[i]), args.volumes)
+    pyAesCryptStretch.cache_clear()
+    timeit('stretch, hashlib, cold cache', lambda i: pyAesCryptStretch('password', ivs[i]), args.volumes)
+    timeit('stretch, hashlib, warm cache', lambda i: pyAesCryptStretch('password', ivs[i]), args.volumes)
+
+    try:
+        import pyAesCrypt
+    except ImportError:
+        print('install pyAesCrypt to also time opening real volumes')
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        plain = os.path.join(tmp, 'plain')
+        with open(plain, 'wb') as f:
+            f.write(os.urandom(1024))
+        for i in range(args.volumes):
+            paths.append(os.path.join(tmp, '%d.aes' % i))
+            pyAesCrypt.encryptFile(plain, paths[i], 'password', 64 * 1024)
+        def openVolume(i):
+            AesCryptReader(paths[i], 'password').close()
+        pyAesCryptStretch.cache_clear()
+        timeit('open volume, cold cache', openVolume, args.volumes)
+        timeit('open volume, warm cache', openVolume, args.volumes)
+
+def legacyBuildBlockIndex(db, volumes):
+    # createBlockIdsToFilenames before the bulk loading changes
+    import base64
+    with db:
+        c = db.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS BlockIdToFile (
+            BlockId TEXT,
+            FileNum INTEGER)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS IxBlockId ON BlockIdToFile(BlockId)''')
+        c.execute('''DELETE FROM BlockIdToFile WHERE 1''')
+        for num, name, size, mtime, keys in volumes:
+            for key in keys:
+                c.execute('INSERT INTO BlockIdToFile (BlockId, FileNum) VALUES (?, ?)',
+                    [base64.b64encode(key), num])
+        c.execute('INSERT INTO BlockIdToFile (BlockId, FileNum) VALUES (?, ?)',
+            [b'summary', -1])
+        c.close()
+        db.commit()
+
+def benchIndexBuild(args):
+    # build the BlockIdToFile index from random block hashes, without
+    # reading any dblock, so only the database work is measured
+    import sqlite3
+    from restore_from_python import buildBlockIndex
+    perVolume = args.blocks // args.volumes
+    volumes = [(num + 1, 'dblock%d' % num, 0, 0, [os.urandom(32) for _ in range(perVolume)])
+        for num in range(args.volumes)]
+    for label, builder in [('legacy', legacyBuildBlockIndex), ('bulk', buildBlockIndex)]:
+        with tempfile.TemporaryDirectory() as tmp:
+            dbpath = os.path.join(tmp, 'index.sqlite')
+            db = sqlite3.connect(dbpath)
+            db.execute("PRAGMA page_size = 16384")
+            t = time.perf_counter()
+            builder(db, volumes)
+            elapsed = time.perf_counter() - t
+            db.close()
+            print('%-8s %9d blocks %8.2f s %10.0f blocks/s %8.1f MB' % (label, perVolume * args.volumes,
+                elapsed, perVolume * args.volumes / elapsed, os.path.getsize(dbpath) / 1024 / 1024))
+
+def makeFilelist(count):
+    # a filelist.json like the ones in dlist files, some files have blocklists
+    import json
+    import base64
+    entries = []
+    for i in range(count):
+        h = base64.b64encode(os.urandom(32)).decode('ascii')
+        entry = {"type": "File", "path": "/home/user/documents/folder%d/file \u00e9 %d.txt" % (i % 100, i),
+            "hash": h, "size": i * 1000, "time": "20240101T000000Z", "metahash": h, "metasize": 137}
+        if i % 10 == 0:
+            entry["blocklists"] = [h] * (1 + i % 4)
+        entries.append(entry)
+    return json.dumps(entries)
+
+def legacyStreamJsonArrayItems(f):
+    # streamJsonArrayItems before ijson.iter_array_items, going through parse events
+    import ijson
+    level = 0
+    currentObject = ijson.ObjectBuilder()
+    parsed = ijson.parse(f)
+    next(parsed)
+    for _, event, value in parsed:
+        currentObject.event(event, value)
+        if event == 'start_map':
+            level += 1
+        elif event == 'end_map':
+            level -= 1
+            if level == 0:
+                yield currentObject.value
+                currentObject = ijson.ObjectBuilder()
+
+def benchDlistParse(args):
+    # parse a filelist.json with every parser. with --scope, the events
+    # parser filters afterwards and the others skip entries while parsing
+    import io
+    import fnmatch
+    import ijson
+    from restore_from_python import DLIST_FIELDS
+    text = makeFilelist(args.entries)
+    pushdown = {}
+    if args.scope:
+        pushdown = dict(key='path', predicate=lambda path: fnmatch.fnmatch(path, args.scope), fields=DLIST_FIELDS)
+
+    def events(f):
+        for item in legacyStreamJsonArrayItems(f):
+            if not args.scope:
+                yield item
+            elif fnmatch.fnmatch(item['path'], args.scope):
+                yield dict((name, value) for name, value in item.items() if name in DLIST_FIELDS)
+    results = []
+    for label, parser in [('events', events),
+            ('lexer', lambda f: ijson.iter_array_items(f, use_json=False, **pushdown)),
+            ('json', lambda f: ijson.iter_array_items(f, **pushdown))]:
+        t = time.perf_counter()
+        items = list(parser(io.StringIO(text)))
+        elapsed = time.perf_counter() - t
+        results.append(items)
+        print('%-8s %9d entries %8.2f s %10.0f entries/s' % (label, len(items), elapsed, args.entries / elapsed))
+    assert all(items == results[0] for items in results), 'parsers disagree'
+
+def main():
+    parser = argparse.ArgumentParser(description="restore_from_python microbenchmarks")
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+    p = sub.add_parser('aes-header', help='key stretching and header check per .aes volume')
+    p.add_argument('--volumes', type=int, default=200)
+    p.set_defaults(fn=benchAesHeader)
+    p = sub.add_parser('index-build', help='building the blockid to dblock index')
+    p.add_argument('--blocks', type=int, default=1000000)
+    p.add_argument('--volumes', type=int, default=1000)
+    p.set_defaults(fn=benchIndexBuild)
+    p = sub.add_parser('dlist-parse', help='parsing filelist.json of a dlist')
+    p.add_argument('--entries', type=int, default=100000)
+    p.add_argument('--scope', help='only keep entries matching this glob, like -s of the restore')
+    p.set_defaults(fn=benchDlistParse)
+    args = parser.parse_args()
+    args.fn(args)
+
+if __name__ == '__main__':
+    main()
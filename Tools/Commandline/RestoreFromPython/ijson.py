@@ -23,6 +23,8 @@
 # on any theory of liability, whether in contract, strict liability, or tort
 # (including negligence or otherwise) arising in any way out of the use of this
 # software, even if advised of the possibility of such damage.
+#
+# iter_array_items and build_value added for restore_from_python
 
 from __future__ import unicode_literals
 import decimal
@@ -281,6 +283,222 @@ def parse(file, buf_size=BUFSIZE):
 def items(file, prefix):
     return items_impl(parse(file), prefix)
 
+def build_value(lexer, symbol, pos):
+    # builds the value starting at symbol directly from the lexemes
+    if symbol == '{':
+        mapval = {}
+        pos, symbol = next(lexer)
+        if symbol != '}':
+            while True:
+                if symbol[0] != '"':
+                    raise UnexpectedSymbol(symbol, pos)
+                key = unescape(symbol[1:-1])
+                pos, symbol = next(lexer)
+                if symbol != ':':
+                    raise UnexpectedSymbol(symbol, pos)
+                pos, symbol = next(lexer)
+                mapval[key] = build_value(lexer, symbol, pos)
+                pos, symbol = next(lexer)
+                if symbol == '}':
+                    break
+                if symbol != ',':
+                    raise UnexpectedSymbol(symbol, pos)
+                pos, symbol = next(lexer)
+        return mapval
+    elif symbol == '[':
+        array = []
+        pos, symbol = next(lexer)
+        if symbol != ']':
+            while True:
+                array.append(build_value(lexer, symbol, pos))
+                pos, symbol = next(lexer)
+                if symbol == ']':
+                    break
+                if symbol != ',':
+                    raise UnexpectedSymbol(symbol, pos)
+                pos, symbol = next(lexer)
+        return array
+    elif symbol == 'null':
+        return None
+    elif symbol == 'true':
+        return True
+    elif symbol == 'false':
+        return False
+    elif symbol[0] == '"':
+        return unescape(symbol[1:-1])
+    else:
+        try:
+            return number(symbol)
+        except decimal.InvalidOperation:
+            raise UnexpectedSymbol(symbol, pos)
+
+def skip_value(lexer, symbol):
+    # consumes the value starting at symbol without building it
+    depth = 0
+    while True:
+        if symbol == '{' or symbol == '[':
+            depth += 1
+        elif symbol == '}' or symbol == ']':
+            depth -= 1
+        if depth == 0:
+            return
+        pos, symbol = next(lexer)
+
+SKIPPED = object()
+
+def build_item(lexer, symbol, pos, key, predicate, fields):
+    # like build_value, but for an object it returns SKIPPED as soon as the
+    # value of key fails predicate, and leaves out members not in fields
+    if symbol != '{':
+        return build_value(lexer, symbol, pos)
+    mapval = {}
+    pos, symbol = next(lexer)
+    if symbol != '}':
+        while True:
+            if symbol[0] != '"':
+                raise UnexpectedSymbol(symbol, pos)
+            name = unescape(symbol[1:-1])
+            pos, symbol = next(lexer)
+            if symbol != ':':
+                raise UnexpectedSymbol(symbol, pos)
+            pos, symbol = next(lexer)
+            if name == key and predicate is not None:
+                value = build_value(lexer, symbol, pos)
+                if not predicate(value):
+                    # skip the rest of the object
+                    skip_value(lexer, '{')
+                    return SKIPPED
+                if fields is None or name in fields:
+                    mapval[name] = value
+            elif fields is None or name in fields:
+                mapval[name] = build_value(lexer, symbol, pos)
+            else:
+                skip_value(lexer, symbol)
+            pos, symbol = next(lexer)
+            if symbol == '}':
+                break
+            if symbol != ',':
+                raise UnexpectedSymbol(symbol, pos)
+            pos, symbol = next(lexer)
+    return mapval
+
+def iter_array_items_lexer(file, buf_size=BUFSIZE, key=None, predicate=None, fields=None):
+    # pure python variant of iter_array_items, building each item straight
+    # from the lexemes instead of going through parse events
+    lexer = iter(Lexer(file, buf_size))
+    filtered = predicate is not None or fields is not None
+    try:
+        pos, symbol = next(lexer)
+        if symbol != '[':
+            raise UnexpectedSymbol(symbol, pos)
+        pos, symbol = next(lexer)
+        if symbol != ']':
+            while True:
+                if filtered:
+                    item = build_item(lexer, symbol, pos, key, predicate, fields)
+                    if item is not SKIPPED:
+                        yield item
+                else:
+                    yield build_value(lexer, symbol, pos)
+                pos, symbol = next(lexer)
+                if symbol == ']':
+                    break
+                if symbol != ',':
+                    raise UnexpectedSymbol(symbol, pos)
+                pos, symbol = next(lexer)
+    except StopIteration:
+        raise IncompleteJSONError('Incomplete JSON data')
+    for pos, symbol in lexer:
+        raise JSONError('Additional data')
+
+JSON_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+NUMBER_START = frozenset('-0123456789')
+NUMBER_CONTINUE = frozenset('0123456789eE.+-')
+
+def iter_array_items(file, buf_size=1024 * 1024, use_json=True, key=None, predicate=None, fields=None):
+    # yields the items of the top-level array in file. each item is decoded
+    # by one call to the C scanner of the json module: the text is read into
+    # a buffer that slides over the file, an item that is cut off at the end
+    # of the buffer fails to decode and is decoded again once more data was
+    # read. numbers come out the same as with the other parsers of this module.
+    # with predicate, object items whose value for key fails predicate are
+    # skipped, with fields only those members of object items are kept.
+    # the pure python variant skips them without building them, here they
+    # are still decoded as that is faster than matching their extent.
+    if not use_json:
+        for item in iter_array_items_lexer(file, key=key, predicate=predicate, fields=fields):
+            yield item
+        return
+    import json
+    if isinstance(file.read(0), bytetype):
+        file = getreader('utf-8')(file)
+    decoder = json.JSONDecoder(parse_float=number)
+    buf = ''
+    pos = 0
+    eof = False
+
+    def next_symbol():
+        # skips whitespace, reading more if needed. returns '' at the end of the file
+        nonlocal buf, pos, eof
+        while True:
+            pos = JSON_WHITESPACE_RE.match(buf, pos).end()
+            if pos < len(buf) or eof:
+                return buf[pos:pos + 1]
+            data = file.read(buf_size)
+            eof = not data
+            buf = data
+            pos = 0
+
+    symbol = next_symbol()
+    if symbol != '[':
+        raise UnexpectedSymbol(symbol, pos)
+    pos += 1
+    if next_symbol() == ']':
+        pos += 1
+    else:
+        read_size = buf_size
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+                # a number is only complete when followed by something that
+                # cannot continue it: with '1' of '1.5e3' at the end of the
+                # buffer, '1', '1.' or '1.5e' decode to a shorter number
+                complete = eof or (end < len(buf) and
+                    (buf[pos] not in NUMBER_START or buf[end] not in NUMBER_CONTINUE))
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise JSONError(str(e))
+                complete = False
+            if not complete:
+                # keep the start of the item, read more (more each time for large items)
+                data = file.read(read_size)
+                eof = not data
+                buf = buf[pos:] + data
+                pos = 0
+                read_size *= 2
+                continue
+            read_size = buf_size
+            pos = end
+            if not isinstance(item, dict):
+                yield item
+            elif not (predicate and key in item and not predicate(item[key])):
+                if fields is not None:
+                    item = {name: item[name] for name in fields if name in item}
+                yield item
+
+            symbol = next_symbol()
+            if symbol == ']':
+                pos += 1
+                break
+            if not symbol:
+                raise IncompleteJSONError('Incomplete JSON data')
+            if symbol != ',':
+                raise UnexpectedSymbol(symbol, pos)
+            pos += 1
+            next_symbol()
+    if next_symbol():
+        raise JSONError('Additional data')
+
 def b2s(b):
     return b.decode('utf-8')
 
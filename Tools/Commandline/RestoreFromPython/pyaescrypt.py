@@ -1,6 +1,7 @@
 # pyAesCrypt 0.1.2
 # Copyright 2016 Marco Bellaccini - marco.bellaccini[at!]gmail.com
 # small modifications by Ben Fisher to add fncallback feature
+# streaming AesCryptReader, decrypting in large pieces into preallocated buffers
 #
 # Licensed under the Apache License, Version 2.0 (the "License");
 # you may not use this file except in compliance with the License.
@@ -14,19 +15,66 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os
+import functools
+import hashlib
+import io
 
-def pyAesCryptDecrypt(path, passw, fncallback=None):
-    from Crypto.Hash import SHA256
-    from Crypto.Hash import HMAC
-    from Crypto.Cipher import AES
+# ciphertext is read and decrypted in pieces of this size
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024
+AES_BLOCK_SIZE = 16
 
-    outbytes = b''
-    assert path.endswith('.aes'), '%s expected to end with .aes' % path
-    with open(path, "rb") as fIn:
+def pyAesCryptDecrypt(path, passw, fncallback=None, bufferSize=DEFAULT_BUFFER_SIZE):
+    # decrypt the whole file. fncallback receives the plaintext in pieces,
+    # without a callback the plaintext is returned. path can also be a binary
+    # file object, such as the ciphertext already read into a BytesIO.
+    assert not isinstance(path, str) or path.endswith('.aes'), '%s expected to end with .aes' % path
+    with AesCryptReader(path, passw, bufferSize) as reader:
+        if fncallback:
+            while True:
+                pText = reader.read(bufferSize)
+                if not pText:
+                    break
+                fncallback(pText)
+            return b''
+
+        # decrypt straight into a buffer of the final size
+        outbytes = bytearray(reader.size)
+        view = memoryview(outbytes)
+        pos = 0
+        while pos < len(outbytes):
+            n = reader.readinto(view[pos:pos + bufferSize])
+            if not n:
+                fail_with_msg("Error: file is corrupted.")
+            pos += n
+        assert reader.read(1) == b''
+        view.release()
+    return bytes(outbytes)
+
+class AesCryptReader(io.RawIOBase):
+    # file-like object returning the plaintext of an AES Crypt (version 2) file.
+    # the HMAC of the ciphertext is verified before the last piece is returned.
+    def __init__(self, path, passw, bufferSize=DEFAULT_BUFFER_SIZE):
+        self._fIn = open(path, "rb") if isinstance(path, str) else path
+        try:
+            self._readHeader(passw)
+        except:
+            self._fIn.close()
+            raise
+        self._bufferSize = max(AES_BLOCK_SIZE, bufferSize - bufferSize % AES_BLOCK_SIZE)
+        self._cBuffer = None
+        self._pending = b''
+
+    def _readHeader(self, passw):
+        from Crypto.Hash import SHA256
+        from Crypto.Hash import HMAC
+        from Crypto.Cipher import AES
+
+        fIn = self._fIn
+        sizeInputFile = fIn.seek(0, io.SEEK_END)
+        fIn.seek(0)
         fdata = fIn.read(3)
         # check if file is in AES Crypt format (also min length check)
-        if fdata != bytes("AES", "utf8") or os.stat(path).st_size < 136:
+        if fdata != bytes("AES", "utf8") or sizeInputFile < 136:
             fail_with_msg("Error: file is corrupted or " +
                 "not an AES Crypt (or pyAesCrypt) file.")
 
@@ -88,76 +136,98 @@ def pyAesCryptDecrypt(path, passw, fncallback=None):
         intKey = iv_key[16:]
 
         # instantiate another AES cipher
-        cipher0 = AES.new(intKey, AES.MODE_CBC, iv0)
+        self._cipher0 = AES.new(intKey, AES.MODE_CBC, iv0)
 
         # instantiate actual HMAC-SHA256 of the ciphertext
-        hmac0Act = HMAC.new(intKey, digestmod=SHA256)
-
-        # decrypt ciphertext in large pieces first, then smaller pieces
-        sizeInputFile = os.stat(path).st_size
-        for currentBufferSize in [64*64*AES.block_size, 64*AES.block_size, AES.block_size]:
-            assert 0 == currentBufferSize % AES.block_size
-            while fIn.tell() < sizeInputFile - 32 - 1 - currentBufferSize:
-                # read data
-                cText = fIn.read(currentBufferSize)
-                # update HMAC
-                hmac0Act.update(cText)
-                # decrypt data
-                if fncallback:
-                    fncallback(cipher0.decrypt(cText))
-                else:
-                    outbytes += bytearray(cipher0.decrypt(cText))
-
-        # last block reached, remove padding if needed
-        # read last block
-        if fIn.tell() != os.stat(path).st_size - 32 - 1:  # this is for empty files
-            cText = fIn.read(AES.block_size)
-            if len(cText) < AES.block_size:
-                fail_with_msg("Error: file is corrupted.")
-        else:
-            cText = bytes()
+        self._hmac0Act = HMAC.new(intKey, digestmod=SHA256)
 
-        # update HMAC
-        hmac0Act.update(cText)
-
-        # read plaintext file size mod 16 lsb positions
+        # the ciphertext is followed by the plaintext file size mod 16
+        # and the HMAC-SHA256 of the ciphertext
+        self._cRemaining = sizeInputFile - fIn.tell() - 32 - 1
+        if self._cRemaining < 0 or self._cRemaining % AES_BLOCK_SIZE != 0:
+            fail_with_msg("Error: file is corrupted.")
+        startCiphertext = fIn.tell()
+        fIn.seek(startCiphertext + self._cRemaining)
         fs16 = fIn.read(1)
-        if len(fs16) < 1:
+        fIn.seek(startCiphertext)
+        # padding to remove from the last block
+        self._toremove = ((16-fs16[0])%16) if self._cRemaining else 0
+        self.size = self._cRemaining - self._toremove
+        self._verified = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        if self._pending:
+            # left over from a read smaller than the aes block size
+            n = min(len(view), len(self._pending))
+            view[:n] = self._pending[:n]
+            self._pending = self._pending[n:]
+            return n
+        if not self._cRemaining:
+            self._verifyHmac()
+            return 0
+
+        want = min(len(view), self._cRemaining, self._bufferSize)
+        want -= want % AES_BLOCK_SIZE
+        if want == 0:
+            # buffer is smaller than one aes block, keep the rest for later
+            self._pending = bytes(self._decryptInto(bytearray(AES_BLOCK_SIZE)))
+            return self.readinto(view)
+
+        return len(self._decryptInto(view[:want]))
+
+    def _decryptInto(self, out):
+        # decrypt len(out) bytes of ciphertext into out, returns the plaintext part of out
+        if self._cBuffer is None or len(self._cBuffer) < len(out):
+            self._cBuffer = bytearray(min(self._bufferSize, self._cRemaining))
+        cText = memoryview(self._cBuffer)[:len(out)]
+        if self._fIn.readinto(cText) != len(out):
             fail_with_msg("Error: file is corrupted.")
-
-        # decrypt last block
-        pText = cipher0.decrypt(cText)
-
-        # remove padding
-        toremove=((16-fs16[0])%16)
-        if toremove != 0:
-            pText=pText[:-toremove]
-
-        if fncallback:
-            fncallback(pText)
-        else:
-            outbytes += bytearray(pText)
-
-        # read HMAC-SHA256 of the encrypted file
-        hmac0 = fIn.read(32)
+        self._cRemaining -= len(out)
+        # update HMAC
+        self._hmac0Act.update(cText)
+        if not self._cRemaining:
+            self._verifyHmac()
+        # decrypt data
+        self._cipher0.decrypt(cText, output=out)
+        if not self._cRemaining and self._toremove:
+            # last block reached, remove padding
+            return out[:len(out) - self._toremove]
+        return out
+
+    def _verifyHmac(self):
+        if self._verified:
+            return
+        # skip the plaintext file size mod 16, read HMAC-SHA256 of the encrypted file
+        self._fIn.read(1)
+        hmac0 = self._fIn.read(32)
         if len(hmac0) < 32:
             fail_with_msg("Error: file is corrupted.")
 
         # HMAC check
-        if hmac0 != hmac0Act.digest():
+        if hmac0 != self._hmac0Act.digest():
             fail_with_msg("Error: bad HMAC (file is corrupted).")
-    return outbytes
+        self._verified = True
+
+    def close(self):
+        if not self.closed:
+            self._fIn.close()
+        super().close()
 
+# the key only depends on the password and the external iv, so reopening
+# a volume (e.g. after it was evicted from the cache) does not stretch again
+@functools.lru_cache(maxsize=4096)
 def pyAesCryptStretch(passw, iv1):
     # hash the external iv and the password 8192 times
-    from Crypto.Hash import SHA256
+    passwBytes = bytes(passw, "utf_16_le")
+    sha256 = hashlib.sha256
     digest=iv1+(16*b"\x00")
 
     for _ in range(8192):
-        passHash=SHA256.new()
-        passHash.update(digest)
-        passHash.update(bytes(passw,"utf_16_le"))
-        digest=passHash.digest()
+        digest=sha256(digest + passwBytes).digest()
 
     return digest
 
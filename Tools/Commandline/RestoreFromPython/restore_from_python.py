@@ -11,20 +11,30 @@ import argparse
 import datetime
 from datetime import datetime as dt, timedelta as td
 import os
+import re
 import sys
 import io
 import json
 import ijson
 import sqlite3
+import struct
 import zipfile
+import zlib
 import codecs
 import getpass
+import shutil
+import tempfile
+import threading
+import queue
 import fnmatch
+import functools
+import itertools
 import base64
 import hashlib
 import time
 import traceback
-from collections import OrderedDict
+import contextlib
+from collections import OrderedDict, deque
 from pyaescrypt import pyAesCryptDecrypt, fail_with_msg
 
 def mainRestore(options):
@@ -32,54 +42,198 @@ def mainRestore(options):
     outdir = options.output_directory
     passw = options.password
     scope = options.scope_directory
-    # locate dlist
+    # locate dlists, most recent first
     dlists = [name for name in os.listdir(d) if (name.endswith('.dlist.zip') or
         name.endswith('.dlist.zip.aes'))]
+    if not dlists:
+        fail_with_msg('No .dlist.zip files found.')
+    dlists.sort(reverse=True)
+    selected = selectVersions(dlists, options.version, options.time)
+    if options.version is None and options.time is None:
+        print('using %s which looks like the most recent dlist.' % selected[0])
+    else:
+        for dlistName in selected:
+            print('using %s, version %d.' % (dlistName, dlists.index(dlistName)))
 
-    if dlists:
-        dlist = sorted(dlists, reverse=True)[0]
-        print('using %s which looks like the most recent dlist.' % dlist)
+    # with --catalog the file list is only read from a dlist once
+    catalog = openCatalog(d, 'py-restore-catalog.sqlite') if options.catalog else None
 
-        # decrypt dlist file to disk
-        if dlist.endswith('.dlist.zip.aes'):
-            with open(os.path.join(d, 'py-restore-dlist-decr.zip'), 'wb') as f:
-                pyAesCryptDecrypt(os.path.join(d, dlist), passw, f.write)
-                dlist = os.path.join(d, 'py-restore-dlist-decr.zip')
-    else:
-        fail_with_msg('No .dlist.zip files found.')
+    stats.progressInterval = options.progress
+
+    if options.list:
+        for dlistName in selected:
+            if len(selected) > 1:
+                print('\n%s:' % dlistName)
+            manifest, items = openDlist(d, dlistName, passw, scope, options.json_parser, catalog)
+            listFiles(items)
+        if catalog:
+            catalog.close()
+        return
+
+    if options.pipeline:
+        options.plan = True
 
     # create cache
-    largestDBlock = max(os.path.getsize(os.path.join(d, name))
-        for name in os.listdir(d) if '.dblock.zip' in name)
     maximum = int(options.max_cache_size) * 1024 * 1024
-    amountInCache = max(1, maximum // largestDBlock)
-    if options.debug: print("max cache size: %d, largest db block: %d, amount in cache: %d" % (maximum, largestDBlock, amountInCache))
-    cacheDecrypted = MemoizeDecorator(pyAesCryptDecrypt, amountInCache, options.debug)
+    spillDir = tempfile.mkdtemp(prefix='py-restore-', dir=options.spill_directory) if options.spill_directory else None
+    if options.debug: print("max cache size: %d, spill directory: %s" % (maximum, spillDir))
+    cacheDecrypted = VolumeCache(pyAesCryptDecrypt, maximum, options.debug, spillDir)
 
-    # read some metadata from the manifest
-    db, numberToName = createDb(d, 'py-restore-index.sqlite', passw, cacheDecrypted)
+    # the index and the cache are shared by all versions
+    with stats.timed('index'):
+        db, numberToName = createDb(d, 'py-restore-index.sqlite', passw, cacheDecrypted, options.dindex)
     dbopts = (db, numberToName, cacheDecrypted, passw)
     if options.debug: print("numbertoname=%s" % numberToName)
-    opts = getArchiveOptions(d, dlist)
+    journal = RestoreJournal(db, options.resume)
 
-    if options.debug:
-        print("options archive: %s" % opts)
-
-    # restore files
-    i = 0
     msgs = 0
-    print('Restoring files...')
-    for item in enumerateDlistFiles(d, dlist):
+    for dlistName in selected:
+        # several versions go to sibling directories named by their time
+        versionOutdir = outdir
+        if len(selected) > 1:
+            versionOutdir = os.path.join(outdir, getDlistTime(dlistName))
+            os.makedirs(versionOutdir, exist_ok=options.resume)
+            print('\nRestoring %s to %s' % (dlistName, versionOutdir))
+
+        # read some metadata from the manifest
+        manifest, items = openDlist(d, dlistName, passw, scope, options.json_parser, catalog)
+        items = stats.timedIter('dlist', items)
+        opts = getArchiveOptions(manifest)
+        opts['verify'] = options.verify
+        opts['pipeline'] = options.pipeline
+
         if options.debug:
-            print("begin restore for file: %s" % item['path'])
+            print("options archive: %s" % opts)
+
+        # restore files
+        i = 0
+        print('Restoring files...')
+        tasks = enumerateRestoreTasks(items, versionOutdir)
+        if options.resume:
+            tasks = journal.skipCompleted(tasks)
+        if options.plan:
+            results = restoreByVolume(d, dbopts, opts, tasks, options.debug,
+                (dlistName, versionOutdir), journal if options.resume else None)
+        elif options.jobs > 1:
+            results = restoreInPool(d, manifest, passw, numberToName, maximum, spillDir, options, tasks)
+        else:
+            # files already restored in an earlier version are cloned from there
+            results = ((item, outPath, restoreTask(d, dbopts, opts, item, outPath, options.debug, journal))
+                for item, outPath in tasks)
+
+        try:
+            for item, outPath, err in results:
+                # print a dot every 10 files to show we're still working,
+                # or with --progress a line with the rates every few seconds
+                i += 1
+                stats.count('files')
+                if stats.progressInterval:
+                    stats.showProgress()
+                elif not options.debug and i % 10 == 0:
+                    sys.stdout.write('.')
+                    sys.stdout.flush()
+                if err:
+                    msgs += 1
+                    stats.count('errors')
+                    print(err)
+                else:
+                    journal.record(item, outPath, opts['verify'])
+        finally:
+            # keep what was completed, also when interrupted
+            journal.flush()
+
+    if options.resume:
+        print('\nskipped %d files restored by an earlier run.' % journal.skipped)
+    db.close()
+    if catalog:
+        catalog.close()
+    if options.debug: print("\ncache: %s" % cacheDecrypted.describe())
+    if spillDir:
+        shutil.rmtree(spillDir, ignore_errors=True)
+    print('\n\n%d warnings/errors seen.' % msgs)
+    if options.progress:
+        print(stats.progressLine())
+    if options.report:
+        with open(options.report, 'w') as f:
+            json.dump(stats.report(), f, indent=2, sort_keys=True)
+        print('wrote timings to %s' % options.report)
+
+def selectVersions(dlists, version, time):
+    # dlists are sorted most recent first, version 0 is the most recent like
+    # in Duplicati. version is a comma separated list of numbers, or all.
+    # time picks the most recent version made at or before it.
+    if time is not None:
+        limit = parseTime(time)
+        before = [name for name in dlists if getDlistTime(name) <= limit]
+        if not before:
+            fail_with_msg('No version was made at or before %s, the oldest is from %s.' %
+                (time, getDlistTime(dlists[-1])))
+        return before[:1]
+    if version is None:
+        return dlists[:1]
+    if version == 'all':
+        return dlists
+    selected = []
+    for part in version.split(','):
+        try:
+            number = int(part)
+        except ValueError:
+            fail_with_msg('--version needs numbers like 0,2,5 or all, got %s' % version)
+        if not 0 <= number < len(dlists):
+            fail_with_msg('There are %d versions, version %d does not exist.' % (len(dlists), number))
+        if dlists[number] not in selected:
+            selected.append(dlists[number])
+    return selected
+
+def getDlistTime(name):
+    # dlists are named like duplicati-20240131T235959Z.dlist.zip, in UTC
+    m = re.search(r'(\d{8}T\d{6}Z)\.dlist\.zip', name)
+    if not m:
+        fail_with_msg('Could not read the time from the name of %s' % name)
+    return m.group(1)
 
-        if item['type'] == 'File' and fnmatch.fnmatch(item['path'], scope):
-            # print a dot every 10 files to show we're still working
-            i += 1
-            if not options.debug and i % 10 == 0:
-                sys.stdout.write('.')
-                sys.stdout.flush()
+def parseTime(text):
+    # accepts the format of dlist names, or iso dates like 2024-01-31 or
+    # 2024-01-31T23:59, in UTC unless an offset is given
+    if re.match(r'^\d{8}T\d{6}Z$', text):
+        return text
+    try:
+        t = dt.fromisoformat(text.replace('Z', '+00:00'))
+    except ValueError:
+        fail_with_msg('Could not parse the time %s, use a format like 2024-01-31T23:59:59' % text)
+    if len(text) == 10:
+        # a date alone includes the whole day
+        t += td(days=1, microseconds=-1)
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=datetime.timezone.utc)
+    return t.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
 
+def openDlist(d, dlistName, passw, scope, jsonParser='json', catalog=None):
+    # returns the manifest and the entries in scope of a dlist
+    dlist = dlistName
+    catalogEntry = getCatalogDlist(catalog, d, dlistName) if catalog else None
+    if catalogEntry:
+        print('the file list of %s is in the catalog.' % dlistName)
+
+    # decrypt dlist file to disk
+    if not catalogEntry and dlist.endswith('.dlist.zip.aes'):
+        with open(os.path.join(d, 'py-restore-dlist-decr.zip'), 'wb') as f, \
+                stats.timed('decrypt', os.path.getsize(os.path.join(d, dlist))):
+            pyAesCryptDecrypt(os.path.join(d, dlist), passw, f.write)
+            dlist = os.path.join(d, 'py-restore-dlist-decr.zip')
+    if catalog and not catalogEntry:
+        print('Adding the file list to the catalog...')
+        catalogEntry = addCatalogDlist(catalog, d, dlistName, dlist, jsonParser)
+
+    if catalogEntry:
+        dlistId, manifest = catalogEntry
+        return manifest, enumerateCatalogFiles(catalog, dlistId, scope)
+    return readManifest(d, dlist), enumerateDlistFiles(d, dlist, jsonParser, scope)
+
+def enumerateRestoreTasks(items, outdir):
+    # yields (item, outPath) for every file in items
+    for item in items:
+        if item['type'] == 'File':
             if item['path'].startswith('\\\\'):
                 # windows network share
                 outPath = outdir + item['path'][1:]
@@ -88,64 +242,618 @@ def mainRestore(options):
                 outPath = outdir + '\\' + item['path'][0] + item['path'][2:]
             else:
                 outPath = outdir + item['path']
-
-            try:
-                restoreOneFile(d, dbopts, opts, item, outPath, options.debug)
-            except Exception as e:
-                _, _, tb = sys.exc_info()
-                msgs += 1
-                te = traceback.extract_tb(tb)
-                fs = te[len(te)-1]
-                print(toAscii('\nWhen restoring %s to %s: %s (%s at line %d)' %
-                    (item['path'], outPath, str(e), os.path.split(fs.filename)[1], fs.lineno)))
+            yield item, outPath
 
         elif item['type'] == 'Symlink':
             print(toAscii('Symlink existed at ' + item['path']))
 
-    db.close()
-    print('\n\n%d warnings/errors seen.' % msgs)
+def restoreTask(d, dbopts, opts, item, outPath, debug, journal=None):
+    # restore one file, returns an error message or None. a file with the
+    # same content as one in the journal is cloned from there.
+    if debug:
+        print("begin restore for file: %s" % item['path'])
+    try:
+        # small files are as quick to restore as to clone
+        source = journal.findContent(item, opts['blocksize']) if journal is not None else None
+        if source:
+            cloneRestoredFile(d, dbopts, opts, item, source, outPath, debug)
+        else:
+            restoreOneFile(d, dbopts, opts, item, outPath, debug)
+    except Exception:
+        return describeRestoreError(item['path'], outPath)
+    return None
 
-def restoreOneFile(d, dbopts, opts, listEntry, outPath, debug):
-    # create destination directory
-    if not os.path.isdir(os.path.split(outPath)[0]):
-        os.makedirs(os.path.split(outPath)[0])
+def describeRestoreError(path, outPath, excInfo=None):
+    # call from an except block, or pass the exception and traceback
+    e, tb = excInfo or sys.exc_info()[1:]
+    te = traceback.extract_tb(tb)
+    fs = te[len(te)-1]
+    return toAscii('\nWhen restoring %s to %s: %s (%s at line %d)' %
+        (path, outPath, str(e), os.path.split(fs.filename)[1], fs.lineno))
 
-    # write to file
-    with open(outPath, 'wb') as f:
-        if 'blocklists' not in listEntry or not listEntry['blocklists']:
-            # small files store data in one block
-            if listEntry["size"] != 0:
-                if debug: print("get one block hash %s" % listEntry['hash'])
-                data = getContentBlock(d, dbopts, listEntry['hash'], debug)
+# state of a worker process when restoring with --jobs
+workerState = {}
+
+def initRestoreWorker(d, manifest, passw, numberToName, maximum, spillDir, verify, debug):
+    # each worker has its own connection to the shared index and its own
+    # cache, the spill directory is shared
+    db = sqlite3.connect(os.path.join(d, 'py-restore-index.sqlite'))
+    cacheDecrypted = VolumeCache(pyAesCryptDecrypt, maximum, debug, spillDir)
+    workerState['d'] = d
+    workerState['dbopts'] = (db, numberToName, cacheDecrypted, passw)
+    workerState['opts'] = getArchiveOptions(manifest)
+    workerState['opts']['verify'] = verify
+    workerState['debug'] = debug
+    # only reads the journal, the main process records the restored files
+    workerState['journal'] = RestoreJournal(db, True)
+    stats.reset()
+
+def restoreWorker(task):
+    # returns the error, and the timings since the previous task
+    item, outPath = task
+    err = restoreTask(workerState['d'], workerState['dbopts'], workerState['opts'],
+        item, outPath, workerState['debug'], workerState['journal'])
+    return err, stats.take()
+
+def restoreInPool(d, manifest, passw, numberToName, maximum, spillDir, options, tasks):
+    # spread the files over a pool of processes. the cache budget is split
+    # between the workers, and only a few tasks per worker are queued at a
+    # time so that the dlist is still streamed.
+    import multiprocessing
+    maximum = maximum // options.jobs
+    if options.debug: print("using %d processes, cache size per process: %d" % (options.jobs, maximum))
+    pending = deque()
+
+    def result():
+        (item, outPath), asyncResult = pending.popleft()
+        err, timings = asyncResult.get()
+        stats.merge(timings)
+        return item, outPath, err
+    with multiprocessing.Pool(options.jobs, initRestoreWorker,
+            (d, manifest, passw, numberToName, maximum, spillDir, options.verify, options.debug)) as pool:
+        for task in tasks:
+            pending.append((task, pool.apply_async(restoreWorker, (task,))))
+            while len(pending) > options.jobs * 4:
+                yield result()
+        while pending:
+            yield result()
+
+def restoreByVolume(d, dbopts, opts, tasks, debug, planFor, journal=None):
+    # restore in two passes: first record for every dblock which blocks go
+    # to which file offsets, then open each dblock once and write its blocks
+    # to all of their destinations. yields (item, outPath, error message or None) per file.
+    # planFor is the (dlist, output directory) of the plan. with journal (--resume)
+    # a complete plan for them is kept, and so are the dblocks it already wrote.
+    db = dbopts[0]
+    if journal is not None and isPlanned(db, planFor):
+        print('Resuming the planned restore...')
+    else:
+        print('Planning restore...')
+        planRestore(d, dbopts, opts, tasks, debug, planFor)
+    print('Writing blocks...')
+    executeRestorePlan(d, dbopts, opts, debug)
+    print('Verifying files...')
+    c = db.cursor()
+    failed = set()
+    for fileId, entry, outPath, metadata, error, copyOf, source in c.execute('''SELECT
+            f.FileId, f.Entry, f.OutPath, f.MetaData, f.Error, f.CopyOf, s.OutPath
+            FROM RestorePlanFile f LEFT JOIN RestorePlanFile s ON s.FileId = f.CopyOf
+            ORDER BY f.FileId'''):
+        listEntry = json.loads(entry)
+        if journal is not None and journal.isComplete(listEntry, outPath):
+            # verified by the run that was interrupted
+            journal.skipped += 1
+            stats.count('skipped')
+            continue
+        if error:
+            failed.add(fileId)
+            yield listEntry, outPath, error
+            continue
+        try:
+            if copyOf is not None:
+                # the source comes first, it is already verified
+                assertTrue(copyOf not in failed, 'could not restore %s to clone it' % source)
+                cloneFile(source, outPath)
+                verifyRestoredFile(dict(opts, verify='none'), listEntry, outPath, debug)
+            else:
+                verifyRestoredFile(opts, listEntry, outPath, debug)
+            restore_metadata_from_data(metadata, outPath, debug)
+        except Exception:
+            failed.add(fileId)
+            yield listEntry, outPath, describeRestoreError(listEntry['path'], outPath)
+        else:
+            yield listEntry, outPath, None
+    c.close()
+
+def isPlanned(db, planFor):
+    # whether the plan in the index database is complete and for planFor
+    try:
+        row = db.execute('''SELECT Complete FROM RestorePlanInfo WHERE Dlist=? AND OutDir=?''',
+            list(planFor)).fetchone()
+    except sqlite3.OperationalError:
+        return False
+    return bool(row and row[0])
+
+def planRestore(d, dbopts, opts, tasks, debug, planFor):
+    # the plan lives next to the block index. a block with Offset -1 is the
+    # metadata of the file, it is kept in RestorePlanFile until the file is verified.
+    # a file with the same content as a planned one only gets its metadata
+    # planned, and is cloned from that file (CopyOf) at the end. Hash is only
+    # set on the files that others can be cloned from. RestorePlanInfo only
+    # gets its row when the plan is committed, RestorePlanDone lists the
+    # dblocks whose blocks were written.
+    db = dbopts[0]
+    with db:
+        c = db.cursor()
+        c.execute('''DROP TABLE IF EXISTS RestorePlanInfo''')
+        c.execute('''DROP TABLE IF EXISTS RestorePlanDone''')
+        c.execute('''DROP TABLE IF EXISTS RestorePlanFile''')
+        c.execute('''DROP TABLE IF EXISTS RestorePlanBlock''')
+        c.execute('''CREATE TABLE RestorePlanInfo (Dlist TEXT, OutDir TEXT, Complete INTEGER)''')
+        c.execute('''CREATE TABLE RestorePlanDone (FileNum INTEGER PRIMARY KEY)''')
+        c.execute('''CREATE TABLE RestorePlanFile (
+            FileId INTEGER PRIMARY KEY,
+            Entry TEXT,
+            OutPath TEXT,
+            MetaData BLOB,
+            Error TEXT,
+            CopyOf INTEGER,
+            Hash TEXT)''')
+        c.execute('''CREATE INDEX IxRestorePlanFileHash ON RestorePlanFile(Hash)''')
+        c.execute('''CREATE TABLE RestorePlanBlock (
+            FileNum INTEGER,
+            BlockId BLOB,
+            FileId INTEGER,
+            Offset INTEGER)''')
+        for item, outPath in tasks:
+            c.execute('''INSERT INTO RestorePlanFile (Entry, OutPath) VALUES (?, ?)''',
+                [json.dumps(item), outPath])
+            fileId = c.lastrowid
+            try:
+                copyOf = c.execute('''SELECT FileId FROM RestorePlanFile WHERE Hash=?''',
+                    [item['hash']]).fetchone()
+                if copyOf:
+                    copyOf = copyOf[0]
+                    c.execute('''UPDATE RestorePlanFile SET CopyOf=? WHERE FileId=?''',
+                        [copyOf, fileId])
+                    blocks = [(-1, item['metahash'])]
+                else:
+                    blocks = [(offset, blockId) for offset, blockId in
+                        enumerateFileBlocks(d, dbopts, opts, item, debug)]
+                    hasHoles = any(blockId == opts['zero-block-hash'] for _, blockId in blocks)
+                    blocks = [(offset, blockId) for offset, blockId in blocks
+                        if blockId != opts['zero-block-hash']]
+                    blocks.append((-1, item['metahash']))
+                rows = [(getFileNumFromBlockId(db, blockId), blockId.encode('utf8'), fileId, offset)
+                    for offset, blockId in blocks]
+
+                # create the file with its final size, blocks are written in any order.
+                # all-zero blocks are not written, they stay holes in the file,
+                # files without them are allocated up front
+                os.makedirs(os.path.split(outPath)[0], exist_ok=True)
+                with open(outPath, 'wb') as f:
+                    if not copyOf and (hasHoles or not preallocate(f, item['size'])):
+                        f.truncate(item['size'])
+            except Exception:
+                c.execute('''UPDATE RestorePlanFile SET Error=? WHERE FileId=?''',
+                    [describeRestoreError(item['path'], outPath), fileId])
+                continue
+            c.executemany('''INSERT INTO RestorePlanBlock (FileNum, BlockId, FileId, Offset)
+                VALUES (?, ?, ?, ?)''', rows)
+            if not copyOf and item['size'] >= opts['blocksize']:
+                c.execute('''UPDATE RestorePlanFile SET Hash=? WHERE FileId=?''', [item['hash'], fileId])
+        c.execute('''CREATE INDEX IxRestorePlanBlock ON RestorePlanBlock(FileNum, BlockId)''')
+        c.execute('''INSERT INTO RestorePlanInfo (Dlist, OutDir, Complete) VALUES (?, ?, 1)''',
+            list(planFor))
+        c.close()
+
+def executeRestorePlan(d, dbopts, opts, debug, maxOpenFiles=64):
+    # dblocks already in RestorePlanDone are skipped, errors of earlier runs are kept
+    db, numberToName, cacheDecrypted, passw = dbopts
+    outFiles = OrderedDict()
+    c = db.cursor()
+    errors = OrderedDict(c.execute('''SELECT FileId, Error FROM RestorePlanFile WHERE Error IS NOT NULL'''))
+    saved = len(errors)
+
+    def volumeDone(num):
+        # once the blocks of dblock num are on disk, it is marked done together
+        # with the metadata and errors recorded so far
+        nonlocal saved
+        for f in outFiles.values():
+            f.flush()
+            os.fsync(f.fileno())
+        with db:
+            db.executemany('''UPDATE RestorePlanFile SET Error=? WHERE FileId=?''',
+                [(error, fileId) for fileId, error in itertools.islice(errors.items(), saved, None)])
+            saved = len(errors)
+            db.execute('''INSERT OR IGNORE INTO RestorePlanDone (FileNum) VALUES (?)''', [num])
+
+    try:
+        fileNums = [row[0] for row in
+            c.execute('''SELECT DISTINCT FileNum FROM RestorePlanBlock
+                WHERE FileNum NOT IN (SELECT FileNum FROM RestorePlanDone) ORDER BY FileNum''')]
+        if opts.get('pipeline'):
+            executeRestorePlanPipelined(d, dbopts, opts, fileNums, outFiles, errors, maxOpenFiles, volumeDone)
+            fileNums = []
+        for num in fileNums:
+            name = numberToName[num]
+            sys.stdout.write('.')
+            sys.stdout.flush()
+            stats.showProgress()
+            rows = getPlanRows(c, num)
+            if debug: print("writing %d blocks from block file %s" % (len(rows), name))
+            try:
+                z = openAsZipFile(d, name, passw, cacheDecrypted)
+            except Exception:
+                for _, fileId, _, outPath in rows:
+                    errors.setdefault(fileId, describeRestoreError(name, outPath))
+                volumeDone(num)
+                continue
+            with z:
+                blocks = extractPlanBlocks(z, name, rows, opts, errors)
+            writePlanBlocks(db, name, blocks, outFiles, errors, maxOpenFiles)
+            volumeDone(num)
+    finally:
+        for f in outFiles.values():
+            f.close()
+        c.close()
+
+def getPlanRows(db, num):
+    # the blocks to write from one dblock file, as (BlockId, FileId, Offset, OutPath)
+    return db.execute('''SELECT BlockId, RestorePlanBlock.FileId, Offset, OutPath
+        FROM RestorePlanBlock JOIN RestorePlanFile ON RestorePlanBlock.FileId = RestorePlanFile.FileId
+        WHERE FileNum=? ORDER BY BlockId''', [num]).fetchall()
+
+def extractPlanBlocks(z, name, rows, opts, errors):
+    # returns (FileId, Offset, OutPath, data) for the blocks of one dblock
+    # file that need writing, metadata blocks have offset -1. a block
+    # used several times is read once. failures are recorded in errors.
+    blocks = []
+    blockId, data = None, None
+    for rowBlockId, fileId, offset, outPath in rows:
+        if fileId in errors:
+            continue
+        try:
+            if rowBlockId != blockId:
+                blockId = rowBlockId
+                with stats.timed('unzip') as timing:
+                    data = timing.bytes = z.read(base64PlainToBase64Url(blockId.decode('utf8')))
+                if opts['verify'] == 'blocks':
+                    verifyBlock(opts, blockId, data)
+        except Exception:
+            blockId = None
+            errors[fileId] = describeRestoreError(name, outPath)
+            continue
+        if offset < 0 or not isZeroBlock(data):
+            blocks.append((fileId, offset, outPath, data))
+    return blocks
+
+def writePlanBlocks(db, name, blocks, outFiles, errors, maxOpenFiles):
+    # writes blocks from extractPlanBlocks. outFiles keeps the most
+    # recently used output files open.
+    for fileId, offset, outPath, data in blocks:
+        if fileId in errors:
+            continue
+        try:
+            if offset < 0:
+                db.execute('''UPDATE RestorePlanFile SET MetaData=? WHERE FileId=?''',
+                    [data, fileId])
+                continue
+            f = outFiles.pop(fileId, None) or open(outPath, 'r+b')
+            outFiles[fileId] = f
+            if len(outFiles) > maxOpenFiles:
+                # synced like the open ones when their dblock is marked done
+                evicted = outFiles.popitem(False)[1]
+                evicted.flush()
+                os.fsync(evicted.fileno())
+                evicted.close()
+            with stats.timed('write', len(data)):
+                f.seek(offset)
                 f.write(data)
-            elif debug:
-                print("file empty, skip to restore metadata")
+            stats.count('blocks')
+        except Exception:
+            errors[fileId] = describeRestoreError(name, outPath)
+
+def executeRestorePlanPipelined(d, dbopts, opts, fileNums, outFiles, errors, maxOpenFiles, volumeDone):
+    # like executeRestorePlan, but the dblock files go through stages that
+    # run at the same time: read, decrypt, unzip and write. the queues between
+    # them are bounded, so only a few dblock files are held in memory.
+    # decrypting, inflating, hashing and file io release the GIL, so threads
+    # are enough. writes and database updates stay on this thread.
+    db, numberToName, cacheDecrypted, passw = dbopts
+    threads = opts['pipeline']
+    dbPath = os.path.join(d, 'py-restore-index.sqlite')
+    local = threading.local()
+
+    def read(item):
+        if not hasattr(local, 'db'):
+            local.db = sqlite3.connect(dbPath)
+        item['rows'] = getPlanRows(local.db, item['num'])
+        with open(os.path.join(d, item['name']), 'rb') as f, stats.timed('read') as timing:
+            item['data'] = timing.bytes = f.read()
+
+    def decrypt(item):
+        if item['name'].endswith('.aes'):
+            with stats.timed('decrypt', len(item['data'])):
+                item['data'] = pyAesCryptDecrypt(io.BytesIO(item['data']), passw)
+
+    def extract(item):
+        with zipfile.ZipFile(io.BytesIO(item['data']), 'r') as z:
+            item['blocks'] = extractPlanBlocks(z, item['name'], item['rows'], opts, errors)
+        item['data'] = None
+
+    volumes = queue.Queue()
+    for num in fileNums:
+        volumes.put({'num': num, 'name': numberToName[num], 'rows': []})
+    volumes.put(None)
+    readQueue, decryptQueue, extractQueue = (queue.Queue(threads) for i in range(3))
+    stages = [PipelineStage('read', read, 1, volumes, readQueue),
+        PipelineStage('decrypt', decrypt, threads, readQueue, decryptQueue),
+        PipelineStage('unzip', extract, threads, decryptQueue, extractQueue),
+        PipelineStage('write', None, 0, extractQueue, None)]
+    writer = stages[-1]
+    while True:
+        item = writer.get()
+        if item is None:
+            break
+        sys.stdout.write('.')
+        sys.stdout.flush()
+        stats.showProgress()
+        t = time.perf_counter()
+        if item.get('error'):
+            for _, fileId, _, outPath in item['rows']:
+                errors.setdefault(fileId, describeRestoreError(item['name'], outPath, item['error']))
+            size = 0
         else:
-            # large files point to a list of blockids, each of which points
-            # to another list of blockids
-            if debug: print("Hash blocks list %s" % listEntry['blocklists'])
-            for blhi, blh in enumerate(listEntry['blocklists']):
-                blockhashoffset = blhi * opts['hashes-per-block'] * opts['blocksize']
-                if debug:
-                    print("hash: %s num_hash: %d, blockhashoffset: %d" % (blh, blhi, blockhashoffset))
-                binaryHashes = getContentBlock(d, dbopts, blh, debug)
-                if debug:
-                    print("got %d binary hashes" % (len(binaryHashes)/opts['hash-size']))
-                for bi, start in enumerate(range(0, len(binaryHashes), opts['hash-size'])):
-                    thehash = binaryHashes[start: start + opts['hash-size']]
-                    thehash = base64.b64encode(thehash)
-                    data = getContentBlock(d, dbopts, thehash, debug)
-                    f.seek(blockhashoffset + bi * opts['blocksize'])
+            writePlanBlocks(db, item['name'], item['blocks'], outFiles, errors, maxOpenFiles)
+            size = sum(len(block[3]) for block in item['blocks'] if block[1] >= 0)
+        volumeDone(item['num'])
+        writer.record(size, time.perf_counter() - t)
+    print('')
+    for stage in stages:
+        print(stage.describe())
+
+class PipelineStage(object):
+    # threads taking items from inQueue, calling fn on them and passing them
+    # to outQueue, a None item marks the end. an exception is kept in the
+    # item and later stages skip it. counts the items, their bytes and the
+    # time spent, and samples the depth of inQueue each time an item is taken.
+    def __init__(self, name, fn, threads, inQueue, outQueue):
+        self.name = name
+        self.fn = fn
+        self.inQueue = inQueue
+        self.outQueue = outQueue
+        self.items = self.bytes = 0
+        self.busy = 0.0
+        self.depthSum = self.depthMax = 0
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.running = threads
+        for i in range(threads):
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def get(self):
+        depth = self.inQueue.qsize()
+        item = self.inQueue.get()
+        with self.lock:
+            self.depthSum += depth
+            self.depthMax = max(self.depthMax, depth)
+        return item
+
+    def record(self, size, elapsed):
+        with self.lock:
+            self.items += 1
+            self.bytes += size
+            self.busy += elapsed
+
+    def run(self):
+        while True:
+            item = self.get()
+            if item is None:
+                # let the other threads of this stage see it too
+                self.inQueue.put(None)
+                break
+            t = time.perf_counter()
+            size = len(item.get('data') or b'')
+            if not item.get('error'):
+                try:
+                    self.fn(item)
+                except Exception:
+                    item['error'] = sys.exc_info()[1:]
+            # the larger of the input and the output, as stages grow or drop the data
+            size = max(size, len(item.get('data') or b''))
+            self.record(size, time.perf_counter() - t)
+            self.outQueue.put(item)
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last:
+            self.outQueue.put(None)
+
+    def describe(self):
+        elapsed = time.perf_counter() - self.started
+        return '%-8s %6d dblocks %10.1f MB, busy %7.2f s (%5.1f MB/s), %3.0f%% of %.2f s, queue depth avg %.1f max %d' % (
+            self.name, self.items, self.bytes / 1048576.0, self.busy,
+            self.bytes / 1048576.0 / self.busy if self.busy else 0, 100 * self.busy / elapsed if elapsed else 0,
+            elapsed, self.depthSum / float(self.items or 1), self.depthMax)
+
+def restoreOneFile(d, dbopts, opts, listEntry, outPath, debug):
+    # create destination directory (exist_ok, another worker may create it concurrently)
+    os.makedirs(os.path.split(outPath)[0], exist_ok=True)
+
+    # write to file. the blocks come in order, so the file hash is computed
+    # while writing instead of reading the file again afterwards.
+    # the file is allocated at its full size up front. blocks repeated
+    # within the file are fetched once, and all-zero blocks are not written
+    # but punched out again, so they become holes.
+    hasher = opts['file-hasher']() if opts['verify'] == 'file' else None
+    recentBlocks = OrderedDict()
+    end = 0
+    hole = None
+    with open(outPath, 'wb') as f:
+        preallocated = preallocate(f, listEntry['size'])
+        for offset, blockId in enumerateFileBlocks(d, dbopts, opts, listEntry, debug):
+            data = recentBlocks.pop(blockId, None)
+            if data is None and blockId == opts['zero-block-hash']:
+                data = bytes(opts['blocksize'])
+            elif data is None:
+                data = getContentBlock(d, dbopts, blockId, debug)
+                if opts['verify'] == 'blocks':
+                    verifyBlock(opts, blockId, data)
+            recentBlocks[blockId] = data
+            if len(recentBlocks) > 16:
+                recentBlocks.popitem(False)
+            if hasher:
+                with stats.timed('verify', len(data)):
+                    hasher.update(data)
+            end = max(end, offset + len(data))
+            if not isZeroBlock(data):
+                with stats.timed('write', len(data)):
+                    f.seek(offset)
                     f.write(data)
+                stats.count('blocks')
+            elif hole and hole[1] == offset:
+                hole[1] = end
+            else:
+                if hole and preallocated:
+                    punchHole(f, hole[0], hole[1] - hole[0])
+                hole = [offset, end]
+        if hole and preallocated:
+            punchHole(f, hole[0], hole[1] - hole[0])
+        if end > os.fstat(f.fileno()).st_size:
+            # the file ends with a hole
+            f.truncate(end)
+
+    if end != listEntry['size']:
+        raise Exception('Restored %s. expected filesize %d and got %d' %
+            (outPath, listEntry['size'], end))
+    verifyRestoredFile(opts, listEntry, outPath, debug, hasher)
+    restore_metadata(d, dbopts, listEntry['metahash'], outPath, debug)
+
+def preallocate(f, size):
+    # reserve the space of the whole file at once, this causes less
+    # fragmentation and metadata updates than growing it block by block
+    if size == 0 or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+        return True
+    except OSError:
+        return False
+
+# fallocate modes (linux/falloc.h)
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+@functools.lru_cache(maxsize=None)
+def getFallocate():
+    try:
+        import ctypes
+        import ctypes.util
+        fallocate = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).fallocate
+        fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        return fallocate
+    except Exception:
+        return None
+
+def punchHole(f, offset, length):
+    # give back the space of a range that should read as zeros, where supported
+    fallocate = getFallocate()
+    return fallocate is not None and fallocate(f.fileno(),
+        FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+def cloneRestoredFile(d, dbopts, opts, listEntry, source, outPath, debug):
+    # the content was verified when source was restored
+    if debug: print("cloning %s from %s" % (outPath, source))
+    os.makedirs(os.path.split(outPath)[0], exist_ok=True)
+    with stats.timed('clone', listEntry['size']):
+        cloneFile(source, outPath)
+    verifyRestoredFile(dict(opts, verify='none'), listEntry, outPath, debug)
+    restore_metadata(d, dbopts, listEntry['metahash'], outPath, debug)
+
+# ioctl to share the data of two files on btrfs/xfs (linux/fs.h)
+FICLONE = 0x40049409
+
+def cloneFile(source, outPath):
+    # use a reflink if the filesystem supports it, else copy inside the
+    # kernel, else copy through python
+    with open(source, 'rb') as fsrc, open(outPath, 'wb') as fdst:
+        try:
+            import fcntl
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except (ImportError, OSError):
+            pass
+        size = os.fstat(fsrc.fileno()).st_size
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while fdst.tell() < size:
+                    if not os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - fdst.tell()):
+                        break
+                    fdst.seek(0, os.SEEK_END)
+                if fdst.tell() == size:
+                    return
+            except OSError:
+                pass
+        fsrc.seek(0)
+        fdst.seek(0)
+        fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+def isZeroBlock(data):
+    return data.count(0) == len(data)
 
+def enumerateFileBlocks(d, dbopts, opts, listEntry, debug):
+    # yields (offset, blockId) for every data block of the file, in order
+    if 'blocklists' not in listEntry or not listEntry['blocklists']:
+        # small files store data in one block
+        if listEntry["size"] != 0:
+            if debug: print("get one block hash %s" % listEntry['hash'])
+            yield 0, listEntry['hash']
+        elif debug:
+            print("file empty, skip to restore metadata")
+    else:
+        # large files point to a list of blockids, each of which points
+        # to another list of blockids
+        if debug: print("Hash blocks list %s" % listEntry['blocklists'])
+        for blhi, blh in enumerate(listEntry['blocklists']):
+            blockhashoffset = blhi * opts['hashes-per-block'] * opts['blocksize']
+            if debug:
+                print("hash: %s num_hash: %d, blockhashoffset: %d" % (blh, blhi, blockhashoffset))
+            binaryHashes = getBlockList(dbopts[0], blh)
+            if binaryHashes is None:
+                binaryHashes = getContentBlock(d, dbopts, blh, debug)
+            if opts['verify'] == 'blocks':
+                verifyBlock(opts, blh, binaryHashes)
+            if debug:
+                print("got %d binary hashes" % (len(binaryHashes)/opts['hash-size']))
+            for bi, start in enumerate(range(0, len(binaryHashes), opts['hash-size'])):
+                thehash = binaryHashes[start: start + opts['hash-size']]
+                thehash = base64.b64encode(thehash).decode('utf8')
+                yield blockhashoffset + bi * opts['blocksize'], thehash
+
+def verifyBlock(opts, blockId, data):
+    if isinstance(blockId, bytes):
+        blockId = blockId.decode('utf8')
+    with stats.timed('verify', len(data)):
+        got = base64.b64encode(opts['block-hasher'](data).digest()).decode('utf8')
+    if got != blockId:
+        raise Exception('Block %s has checksum %s' % (blockId, got))
+
+def verifyRestoredFile(opts, listEntry, outPath, debug, hasher=None):
     # verify file size
     if listEntry['size'] != os.path.getsize(outPath):
         raise Exception('Restored %s. expected filesize %d and got %d' %
             (outPath, listEntry['size'], os.path.getsize(outPath)))
 
-    # verify file checksum
-    hasher = opts['file-hasher']()
-    computeHash(outPath, hasher)
+    if opts['verify'] != 'file':
+        return
+
+    # verify file checksum, reading the file unless the data was hashed while writing
+    if hasher is None:
+        hasher = opts['file-hasher']()
+        with stats.timed('verify', listEntry['size']):
+            computeHash(outPath, hasher)
     expected = listEntry['hash'].encode('utf8')
     x = hasher.digest()
     got = base64.b64encode(x)
@@ -154,7 +862,6 @@ def restoreOneFile(d, dbopts, opts, listEntry, outPath, debug):
     if expected != got:
         raise Exception('Restored %s. expected checksum %s and got %s' %
             (outPath, expected, got))
-    restore_metadata(d, dbopts, listEntry['metahash'], outPath, debug)
 
 def restore_unix(outPath, js, debug):
     ugp = js.get("unix:uid-gid-perm")
@@ -171,7 +878,13 @@ def restore_metadata(d, dbopts, metahash, outPath, debug):
     if debug:
         print("begin restore metadata for file: %s" % outPath)
     data = getContentBlock(d, dbopts, metahash, debug)
-    js = json.loads(data)
+    restore_metadata_from_data(data, outPath, debug)
+
+def restore_metadata_from_data(data, outPath, debug):
+    with stats.timed('metadata'):
+        apply_metadata(json.loads(data), outPath, debug)
+
+def apply_metadata(js, outPath, debug):
     lws = int(js["CoreLastWritetime"])/10
     ct = dt(1,1,1,tzinfo=datetime.timezone.utc) + td(microseconds=lws)
     # do not use mktime, it uses local time
@@ -180,18 +893,28 @@ def restore_metadata(d, dbopts, metahash, outPath, debug):
     if (js.get("unix:owner-name")):
         restore_unix(outPath, js, debug)
     else:
-        restore_windows(outPath, js, debug)
+        restore_windows_metadata(outPath, js, debug)
+
 
+def getBlockList(db, blockId):
+    # the blocklist if a dindex had it, else None
+    row = db.execute('''SELECT Data FROM BlockList WHERE BlockId=?''', [blockIdToKey(blockId)]).fetchone()
+    return row[0] if row else None
 
 def getContentBlock(d, dbopts, blockId, debug):
     if isinstance(blockId, bytes):
         blockId = blockId.decode('utf8')
     db, numberToName, cacheDecrypted, passw = dbopts
-    name = getFilenameFromBlockId(db, numberToName, blockId, debug)
+    num = getFileNumFromBlockId(db, blockId)
+    name = numberToName[num]
     if debug: print("getting content from hash %s in block file %s"  % (blockId, name))
+    if name.endswith('.zip'):
+        # unencrypted, read the member directly from the file
+        return readZipBlock(d, db, num, name, blockId)
     with openAsZipFile(d, name, passw, cacheDecrypted) as z:
-        with z.open(base64PlainToBase64Url(blockId), 'r') as zipContents:
-            return zipContents.read()
+        with z.open(base64PlainToBase64Url(blockId), 'r') as zipContents, stats.timed('unzip') as timing:
+            timing.bytes = zipContents.read()
+            return timing.bytes
 
 def openAsZipFile(d, name, passw, cacheDecrypted):
     fullpath = os.path.join(d, name)
@@ -202,99 +925,405 @@ def openAsZipFile(d, name, passw, cacheDecrypted):
         data = io.BytesIO(cacheDecrypted(fullpath, passw))
         return zipfile.ZipFile(data, 'r')
 
-def enumerateDlistFiles(d, dlist):
+# open dblock .zip files, kept open for reading blocks at known offsets
+zipHandles = OrderedDict()
+
+def getZipHandle(fullpath, maxOpenFiles=64):
+    f = zipHandles.pop(fullpath, None)
+    if f is None:
+        assertTrue(os.path.exists(fullpath), 'missing %s' % fullpath)
+        f = open(fullpath, 'rb')
+    zipHandles[fullpath] = f
+    if len(zipHandles) > maxOpenFiles:
+        zipHandles.popitem(False)[1].close()
+    return f
+
+def readAt(f, offset, size):
+    if hasattr(os, 'pread'):
+        return os.pread(f.fileno(), size, offset)
+    f.seek(offset)
+    return f.read(size)
+
+def readZipBlock(d, db, num, name, blockId):
+    # the central directory of a dblock .zip is parsed once and kept in the
+    # index as the offset of the data of every block, so a block is read
+    # with a single pread instead of parsing the zip again
+    f = getZipHandle(os.path.join(d, name))
+    key = blockIdToKey(blockId)
+    query = '''SELECT DataOffset, CompressSize, Size, CompressType, CRC
+        FROM ZipEntry WHERE FileNum=? AND BlockId=?'''
+    row = db.execute(query, [num, key]).fetchone()
+    if row is None and not db.execute('''SELECT 1 FROM ZipVolume WHERE FileNum=?''', [num]).fetchone():
+        storeZipOffsets(db, num, f)
+        row = db.execute(query, [num, key]).fetchone()
+    assertTrue(row is not None, 'block id %s not found in %s' % (blockId, name))
+
+    offset, compressSize, size, compressType, crc = row
+    with stats.timed('read', compressSize):
+        data = readAt(f, offset, compressSize)
+    with stats.timed('unzip', size):
+        if compressType == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        elif compressType != zipfile.ZIP_STORED:
+            with zipfile.ZipFile(f, 'r') as z:
+                data = z.read(base64PlainToBase64Url(blockId))
+        crcOk = len(data) == size and zlib.crc32(data) == crc
+    if not crcOk:
+        raise zipfile.BadZipFile('Bad CRC-32 for block %s in %s' % (blockId, name))
+    return data
+
+def storeZipOffsets(db, num, f):
+    rows = []
+    with zipfile.ZipFile(f, 'r') as z:
+        for info in z.infolist():
+            if info.filename == 'manifest': continue
+            # the data follows the local header, which has its own name and extra lengths
+            header = readAt(f, info.header_offset, zipfile.sizeFileHeader)
+            nameLength, extraLength = struct.unpack('<HH', header[26:30])
+            dataOffset = info.header_offset + zipfile.sizeFileHeader + nameLength + extraLength
+            rows.append((num, blockIdToKey(base64UrlToBase64Plain(info.filename)), dataOffset,
+                info.compress_size, info.file_size, info.compress_type, info.CRC))
+    with db:
+        # another process may have stored the same volume
+        db.executemany('''INSERT OR IGNORE INTO ZipEntry (FileNum, BlockId, DataOffset,
+            CompressSize, Size, CompressType, CRC) VALUES (?, ?, ?, ?, ?, ?, ?)''', rows)
+        db.execute('''INSERT OR IGNORE INTO ZipVolume (FileNum) VALUES (?)''', [num])
+
+def createZipEntryTables(c):
+    # offsets of the blocks in unencrypted dblock files, filled when a dblock is first read
+    c.execute('''CREATE TABLE IF NOT EXISTS ZipVolume (FileNum INTEGER PRIMARY KEY)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS ZipEntry (
+        FileNum INTEGER,
+        BlockId BLOB,
+        DataOffset INTEGER,
+        CompressSize INTEGER,
+        Size INTEGER,
+        CompressType INTEGER,
+        CRC INTEGER,
+        PRIMARY KEY (FileNum, BlockId)) WITHOUT ROWID''')
+
+# the members of a dlist entry that the restore uses, the pure python parser
+# does not build the others. the json parser has decoded them already, there
+# dropping them would only cost time.
+DLIST_FIELDS = frozenset(['type', 'path', 'hash', 'size', 'metahash', 'blocklists'])
+
+def enumerateDlistFiles(d, dlist, jsonParser='json', scope='*'):
+    # entries with a path outside scope are skipped by the parser
+    predicate = None
+    if scope != '*':
+        predicate = lambda path: fnmatch.fnmatch(path, scope)
+    fields = None if jsonParser == 'json' else DLIST_FIELDS
     convertStreamToUtf8 = codecs.getreader('utf-8-sig')
     with zipfile.ZipFile(os.path.join(d, dlist), 'r') as z:
         with z.open('filelist.json', 'r') as zipentry:
             with convertStreamToUtf8(zipentry) as zipentryutf8:
-                for item in streamJsonArrayItems(zipentryutf8):
+                for item in ijson.iter_array_items(zipentryutf8, use_json=(jsonParser == 'json'),
+                        key='path', predicate=predicate, fields=fields):
                     yield item
 
-def streamJsonArrayItems(f):
-    # read items from a json array -- without loading the entire file into memory
-    level = 0
-    currentObject = ijson.ObjectBuilder()
-    parsed = ijson.parse(f)
+# the catalog keeps the file lists of dlists in sqlite, sorted by path, so
+# that a dlist is decrypted and parsed only once. an entry is used as long as
+# the dlist file has the same name, size and mtime.
+def openCatalog(d, db_filename):
+    db = sqlite3.connect(os.path.join(d, db_filename))
+    db.execute("PRAGMA page_size = 16384")
+    db.execute('''CREATE TABLE IF NOT EXISTS CatalogDlist (DlistId INTEGER PRIMARY KEY,
+        Name TEXT UNIQUE, Size INTEGER, MTime INTEGER, Manifest TEXT)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS CatalogFile (DlistId INTEGER, Path TEXT, Type TEXT,
+        Hash TEXT, Size INTEGER, MetaHash TEXT, BlockLists TEXT,
+        PRIMARY KEY (DlistId, Path)) WITHOUT ROWID''')
+    db.commit()
+    return db
 
-    # eat the initial start_array event
-    assertEqual('start_array', next(parsed)[1])
+def getCatalogDlist(catalog, d, name):
+    # returns (DlistId, manifest) if the catalog has the current file list of name
+    st = os.stat(os.path.join(d, name))
+    row = catalog.execute('''SELECT DlistId, Size, MTime, Manifest FROM CatalogDlist
+        WHERE Name = ?''', (name,)).fetchone()
+    if row and row[1:3] == (st.st_size, st.st_mtime_ns):
+        return row[0], row[3]
+    return None
 
-    # construct objects. use level in order to support objects within objects
-    for _, event, value in parsed:
-        currentObject.event(event, value)
-        if event == 'start_map':
-            level += 1
-        elif event == 'end_map':
-            level -= 1
-            if level == 0:
-                yield currentObject.value
-                currentObject = ijson.ObjectBuilder()
+def addCatalogDlist(catalog, d, name, dlist, jsonParser='json'):
+    # reads the file list of name, decrypted at dlist, into the catalog.
+    # it is committed at once, so an interrupted run leaves no partial list.
+    st = os.stat(os.path.join(d, name))
+    manifest = readManifest(d, dlist)
+    c = catalog.cursor()
+    c.execute('''DELETE FROM CatalogFile WHERE DlistId IN
+        (SELECT DlistId FROM CatalogDlist WHERE Name = ?)''', (name,))
+    c.execute('''DELETE FROM CatalogDlist WHERE Name = ?''', (name,))
+    c.execute('''INSERT INTO CatalogDlist (Name, Size, MTime, Manifest) VALUES (?, ?, ?, ?)''',
+        (name, st.st_size, st.st_mtime_ns, manifest))
+    dlistId = c.lastrowid
+    c.executemany('''INSERT OR REPLACE INTO CatalogFile (DlistId, Path, Type, Hash, Size,
+        MetaHash, BlockLists) VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        ((dlistId, item['path'], item['type'], item.get('hash'), item.get('size'), item.get('metahash'),
+            json.dumps(item['blocklists']) if item.get('blocklists') else None)
+            for item in enumerateDlistFiles(d, dlist, jsonParser)))
+    catalog.commit()
+    c.close()
+    return dlistId, manifest
 
-    # ignore the final end_array event.
+def enumerateCatalogFiles(catalog, dlistId, scope='*'):
+    # like enumerateDlistFiles, in the order of the paths. only the paths
+    # starting with the part of scope before its first wildcard are read.
+    query = '''SELECT Path, Type, Hash, Size, MetaHash, BlockLists FROM CatalogFile
+        WHERE DlistId = ?'''
+    args = [dlistId]
+    prefix = getLiteralPrefix(scope)
+    if prefix:
+        query += ''' AND Path >= ? AND Path < ?'''
+        args += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+    for path, kind, fileHash, size, metahash, blocklists in catalog.execute(query + ''' ORDER BY Path''', args):
+        if scope != '*' and not fnmatch.fnmatch(path, scope):
+            continue
+        item = {'type': kind, 'path': path}
+        if fileHash is not None:
+            item['hash'] = fileHash
+            item['size'] = size
+        if metahash is not None:
+            item['metahash'] = metahash
+        if blocklists is not None:
+            item['blocklists'] = json.loads(blocklists)
+        yield item
+
+def getLiteralPrefix(pattern):
+    # the part of a glob pattern before its first wildcard. empty where
+    # fnmatch ignores case, as the catalog compares paths case sensitively.
+    if os.path.normcase('A') != 'A':
+        return ''
+    for i, ch in enumerate(pattern):
+        if ch in '*?[':
+            return pattern[:i]
+    return pattern
+
+def listFiles(items):
+    # prints the entries instead of restoring them
+    count = 0
+    for item in items:
+        print(toAscii('%-8s %14s  %s' % (item['type'], item.get('size', ''), item['path'])))
+        count += 1
+    print('%d entries.' % count)
 
 # the DB caches a relationship between blockIDs and dblock files.
-def createDb(d, db_filename, passw, cacheDecrypted):
-    # get a summary of the current dblocks
+# it remembers the name, size and mtime of every dblock it has indexed, so
+# only new or changed dblocks are read again and vanished ones are dropped.
+def createDb(d, db_filename, passw, cacheDecrypted, useDindex=False):
+    # get the state of the current dblocks
     zipfilenames = [s for s in os.listdir(d) if
         s.endswith('.dblock.zip') or s.endswith('.dblock.zip.aes')]
     zipfilenames.sort()
-    filenamesAndSizes = ';'.join(zipfilenames)
-    filenamesAndSizes += ';'.join(map(str,
-        [os.path.getsize(os.path.join(d, s)) for s in zipfilenames]))
-    needNew = True
-    dbpath = os.path.join(d, db_filename)
-    if os.path.exists(dbpath):
-        # check that the dblocks we have match the dblocks this db has.
-        dbCheckIfComplete = sqlite3.connect(dbpath)
-        cursor = dbCheckIfComplete.cursor()
-        needNew = not cursor.execute('''SELECT FileNum FROM BlockIdToFile
-            WHERE BlockId=?''', [filenamesAndSizes.encode('utf8')]).fetchone()
-        cursor.close()
-        dbCheckIfComplete.close()
-
-    db = sqlite3.connect(dbpath)
+    volumeStates = OrderedDict()
+    for name in zipfilenames:
+        st = os.stat(os.path.join(d, name))
+        volumeStates[name] = (st.st_size, st.st_mtime_ns)
+
+    dbPath = os.path.join(d, db_filename)
+    db = sqlite3.connect(dbPath)
+    try:
+        setupIndexDb(db)
+        known = getIndexedVolumes(db)
+    except sqlite3.DatabaseError as e:
+        # not a database, or damaged by a run that was killed: start over
+        print(toAscii('The index %s is unreadable (%s), it will be created again.' % (dbPath, str(e))))
+        db.close()
+        for path in [dbPath, dbPath + '-journal']:
+            if os.path.exists(path):
+                os.remove(path)
+        db = sqlite3.connect(dbPath)
+        setupIndexDb(db)
+        known = None
+    if known is None:
+        print('Creating index, this may take some time...')
+        known = {}
+        rebuild = True
+    else:
+        rebuild = False
+
+    # a changed dblock is removed from the index and then indexed again
+    stale = [num for name, (num, size, mtime) in known.items()
+        if volumeStates.get(name) != (size, mtime)]
+    added = [name for name in volumeStates
+        if name not in known or known[name][0] in stale]
+    removed = [name for name in known if name not in volumeStates]
+    if rebuild:
+        pass
+    elif stale or added:
+        print('Updating index, %d new or changed and %d removed dblock files...' %
+            (len(added), len(removed)))
+    else:
+        print('Able to re-use existing index.')
+
+    if rebuild or stale or added:
+        nextNum = max([num for num, _, _ in known.values() if num not in stale] or [0]) + 1
+        newVolumes = OrderedDict((nextNum + n, name) for n, name in enumerate(added))
+        createBlockIdsToFilenames(d, db, passw, cacheDecrypted,
+            newVolumes, volumeStates, stale, rebuild, useDindex)
+
+    numberToName = OrderedDict((num, name) for num, name in
+        db.execute('''SELECT FileNum, Name FROM BlockVolume ORDER BY FileNum'''))
+    return db, numberToName
+
+def setupIndexDb(db):
     cursor = db.cursor()
     cursor.execute("PRAGMA temp_store = memory")
     cursor.execute("PRAGMA page_size = 16384")
     cursor.execute("PRAGMA cache_size = 1000")
+    createZipEntryTables(cursor)
+    # blocklists from the list/ entries of dindex files, so that they are not
+    # fetched from their dblocks. they are found by their hash, so stay valid
+    # when the dblocks change and are kept when the index is rebuilt.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS BlockList (BlockId BLOB PRIMARY KEY, Data BLOB)''')
     cursor.close()
-    numberToName = OrderedDict((n + 1, v) for n, v in enumerate(zipfilenames))
-    if needNew:
-        print('Creating index, this may take some time...')
-        createBlockIdsToFilenames(d, db, passw, cacheDecrypted,
-            numberToName, filenamesAndSizes)
-    else:
-        print('Able to re-use existing index.')
 
-    return db, numberToName
+def getIndexedVolumes(db):
+    # returns {name: (FileNum, size, mtime)}, or None if there is no usable index.
+    # a file that is not a database or is damaged raises sqlite3.DatabaseError
+    try:
+        complete = db.execute('''SELECT Complete FROM BlockIndexInfo''').fetchone()
+        if not complete or not complete[0]:
+            return None
+        return dict((name, (num, size, mtime)) for num, name, size, mtime in
+            db.execute('''SELECT FileNum, Name, Size, MTime FROM BlockVolume'''))
+    except sqlite3.OperationalError:
+        # no index yet, or written by an older version of this script
+        return None
 
-def createBlockIdsToFilenames(d, db, passw, cache, numberToName, filenamesAndSizes):
-    # create an index mapping blockId to filename
-    with db:
-        c = db.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS BlockIdToFile (
-            BlockId TEXT,
-            FileNum INTEGER)''')
-        c.execute('''CREATE INDEX IF NOT EXISTS IxBlockId ON BlockIdToFile(BlockId)''')
-        c.execute('''DELETE FROM BlockIdToFile WHERE 1''')
+def createBlockIdsToFilenames(d, db, passw, cache, numberToName, volumeStates, stale, rebuild,
+        useDindex=False):
+    # add the dblocks in numberToName to the index mapping blockId to filename.
+    # with useDindex the block lists come from the dindex files, and only
+    # dblocks without a matching dindex are opened.
+    fromDindex = readDindexVolumes(d, db, passw, numberToName.values(), volumeStates) if useDindex else {}
+    if useDindex:
+        print('%d of %d dblock files are listed in dindex files.' % (len(fromDindex), len(numberToName)))
+
+    def enumerateVolumes():
         for num in numberToName:
             name = numberToName[num]
+            size, mtime = volumeStates[name]
+            if name in fromDindex:
+                yield num, name, size, mtime, fromDindex.pop(name)
+                continue
             sys.stdout.write('.')
             sys.stdout.flush()
             with openAsZipFile(d, name, passw, cache) as z:
+                yield num, name, size, mtime, [blockIdToKey(base64UrlToBase64Plain(entryname))
+                    for entryname in z.namelist() if entryname != 'manifest']
+
+    buildBlockIndex(db, enumerateVolumes(), stale, rebuild)
+    return numberToName
+
+def readDindexVolumes(d, db, passw, names, volumeStates):
+    # returns {dblock name: [binary block hash, ...]} read from the vol/ entries
+    # of the dindex files. a dblock is left out if its dindex is unreadable
+    # or does not match the size of the dblock, so that it gets scanned.
+    # the list/ entries of the dindex files read go to the BlockList table.
+    names = set(names)
+    result = {}
+    dindexes = sorted(s for s in os.listdir(d) if
+        s.endswith('.dindex.zip') or s.endswith('.dindex.zip.aes'))
+    for dindex in dindexes:
+        try:
+            # dindex files are small and read once, they do not go to the cache
+            with openAsZipFile(d, dindex, passw, pyAesCryptDecrypt) as z:
+                used = False
                 for entryname in z.namelist():
-                    if entryname == 'manifest': continue
-                    entryname = base64UrlToBase64Plain(entryname)
-                    c.execute('INSERT INTO BlockIdToFile (BlockId, FileNum) VALUES (?, ?)',
-                             [entryname.encode('utf8'), num])
-
-        # write a summary of the current dblocks
-        c.execute('INSERT INTO BlockIdToFile (BlockId, FileNum) VALUES (?, ?)',
-                 [filenamesAndSizes.encode('utf8'), -1])
+                    if not entryname.startswith('vol/') or entryname[4:] not in names:
+                        continue
+                    name = entryname[4:]
+                    vol = json.loads(z.read(entryname).decode('utf-8-sig'))
+                    if 'volumesize' in vol and vol['volumesize'] != volumeStates[name][0]:
+                        print(toAscii('\n%s lists %s with size %d, but it has size %d, it will be scanned.' %
+                            (dindex, name, vol['volumesize'], volumeStates[name][0])))
+                        continue
+                    result[name] = [blockIdToKey(block['hash']) for block in vol['blocks']]
+                    used = True
+                # only for the dblocks being indexed, the others were done before
+                if used:
+                    db.executemany('''INSERT OR IGNORE INTO BlockList (BlockId, Data) VALUES (?, ?)''',
+                        ((blockIdToKey(base64UrlToBase64Plain(entryname[5:])), z.read(entryname))
+                            for entryname in z.namelist() if entryname.startswith('list/')))
+        except Exception as e:
+            print(toAscii('\nCould not read %s, its dblock files will be scanned: %s' % (dindex, str(e))))
+    db.commit()
+    return result
+
+def buildBlockIndex(db, volumes, stale=(), rebuild=True):
+    # volumes yields (FileNum, name, size, mtime, [binary block hash, ...]).
+    # the rows are bulk loaded into a table without any index in a separate
+    # file, then copied sorted into the WITHOUT ROWID table so its b-tree is
+    # built in a single pass and the index file does not keep the free pages
+    # of the load. only the load file goes without journal and syncs, it is
+    # thrown away after. the index file keeps its journal, it also holds the
+    # --resume journal and must survive a build that is killed.
+    with db:
+        c = db.cursor()
+        if rebuild:
+            c.execute('''DROP TABLE IF EXISTS BlockIndexInfo''')
+            c.execute('''DROP TABLE IF EXISTS BlockIndexSummary''')
+            c.execute('''DROP TABLE IF EXISTS BlockVolume''')
+            c.execute('''DROP TABLE IF EXISTS BlockIdToFile''')
+            c.execute('''DROP TABLE IF EXISTS ZipVolume''')
+            c.execute('''DROP TABLE IF EXISTS ZipEntry''')
+            createZipEntryTables(c)
+            c.execute('''CREATE TABLE BlockIndexInfo (Complete INTEGER)''')
+            c.execute('''INSERT INTO BlockIndexInfo (Complete) VALUES (0)''')
+            c.execute('''CREATE TABLE BlockVolume (
+                FileNum INTEGER PRIMARY KEY,
+                Name TEXT UNIQUE,
+                Size INTEGER,
+                MTime INTEGER)''')
+            # a block can be in more than one dblock, all are kept so the
+            # block is still found when one of the dblocks is removed
+            c.execute('''CREATE TABLE BlockIdToFile (
+                BlockId BLOB,
+                FileNum INTEGER,
+                PRIMARY KEY (BlockId, FileNum)) WITHOUT ROWID''')
+        c.execute('''UPDATE BlockIndexInfo SET Complete=0''')
         c.close()
-        db.commit()
 
-    return numberToName
+    loadpath = db.execute("PRAGMA database_list").fetchone()[2] + '-load'
+    # left over by a build that was killed, possibly not even a database
+    if os.path.exists(loadpath):
+        os.remove(loadpath)
+    db.execute("ATTACH DATABASE ? AS load", [loadpath])
+    db.execute("PRAGMA load.journal_mode = OFF")
+    db.execute("PRAGMA load.synchronous = OFF")
+    try:
+        with db:
+            c = db.cursor()
+            if stale:
+                c.executemany('''DELETE FROM BlockVolume WHERE FileNum=?''',
+                    [[num] for num in stale])
+                c.execute('''DELETE FROM BlockIdToFile
+                    WHERE FileNum NOT IN (SELECT FileNum FROM BlockVolume)''')
+                c.execute('''DELETE FROM ZipVolume
+                    WHERE FileNum NOT IN (SELECT FileNum FROM BlockVolume)''')
+                c.execute('''DELETE FROM ZipEntry
+                    WHERE FileNum NOT IN (SELECT FileNum FROM BlockVolume)''')
+
+            c.execute('''DROP TABLE IF EXISTS load.BlockIdToFileLoad''')
+            c.execute('''CREATE TABLE load.BlockIdToFileLoad (
+                BlockId BLOB,
+                FileNum INTEGER)''')
+            for num, name, size, mtime, keys in volumes:
+                c.executemany('INSERT INTO load.BlockIdToFileLoad (BlockId, FileNum) VALUES (?, ?)',
+                    ((key, num) for key in keys))
+                c.execute('''INSERT INTO BlockVolume (FileNum, Name, Size, MTime)
+                    VALUES (?, ?, ?, ?)''', [num, name, size, mtime])
+            c.execute('''INSERT OR IGNORE INTO BlockIdToFile (BlockId, FileNum)
+                SELECT BlockId, FileNum FROM load.BlockIdToFileLoad ORDER BY BlockId, FileNum''')
+            c.execute('''UPDATE BlockIndexInfo SET Complete=1''')
+            c.close()
+    finally:
+        db.execute("DETACH DATABASE load")
+        os.remove(loadpath)
+
+def blockIdToKey(blockId):
+    # the index stores the binary hash instead of its base64 text
+    return base64.b64decode(blockId)
 
 def base64PlainToBase64Url(data):
     if isinstance(data, bytes): return data.replace(b'+', b'-').replace(b'/', b'_')
@@ -312,16 +1341,13 @@ def computeHash(path, hasher, buffersize=64 * 1024):
                 break
             hasher.update(buffer)
 
-def getFilenameFromBlockId(db, numberToName, blockId, debug):
-    c = db.cursor()
+def getFileNumFromBlockId(db, blockId):
     if isinstance(blockId, str):
         blockId = blockId.encode('utf8')
-    rows = c.execute('SELECT FileNum FROM BlockIdToFile WHERE BlockId=?', [blockId])
-    s = None
-    for row in rows:
-        return numberToName[row[0]]
-    assertTrue(False, 'block id %s not found' % blockId)
-    c.close()
+    row = db.execute('SELECT FileNum FROM BlockIdToFile WHERE BlockId=? LIMIT 1',
+        [blockIdToKey(blockId)]).fetchone()
+    assertTrue(row is not None, 'block id %s not found' % blockId)
+    return row[0]
 
 def toAscii(s):
     import unicodedata
@@ -338,30 +1364,238 @@ def assertTrue(condition, *context):
         s = ' '.join(context) if context else ''
         raise AssertionError(toAscii(s))
 
-# code.activestate.com/recipes/496879-memoize-decorator-function-with-cache-size-limit/
-def MemoizeDecorator(fn, cachesize, debug):
-    cache = OrderedDict()
-    def memoize_wrapper(*args, **kwargs):
-        import pickle
-        key = pickle.dumps((args, kwargs))
+class VolumeCache(object):
+    # decrypted dblocks by volume name, least recently used ones are evicted
+    # once their total size is over maxBytes. with a spill directory an
+    # evicted volume is written there, and read back instead of decrypted again.
+    def __init__(self, fn, maxBytes, debug, spillDir=None):
+        self.fn = fn
+        self.maxBytes = maxBytes
+        self.debug = debug
+        self.spillDir = spillDir
+        self.cache = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = self.spillReads = 0
+
+    def __call__(self, path, passw):
+        name = os.path.basename(path)
         try:
-            return cache[key]
-        except KeyError:
-            if debug:
-                t = time.time()
-            result = fn(*args, **kwargs)
-            cache[key] = result
-            if debug:
-                t2 = time.time()
-                print("block cached, key: %s, bytes: %d necessary time %3.3f" % (key, len(result), round(t2-t,3)))
-            if len(cache) > memoize_wrapper._limit:
-                # remove like in a FIFO queue
-                cache.popitem(False)
+            result = self.cache[name]
+            self.cache.move_to_end(name)
+            self.hits += 1
+            stats.count('cache hits')
             return result
+        except KeyError:
+            pass
+
+        self.misses += 1
+        stats.count('cache misses')
+        if self.debug:
+            t = time.time()
+        spillPath = self.spillDir and os.path.join(self.spillDir, name + '.decrypted')
+        if spillPath and os.path.exists(spillPath):
+            with open(spillPath, 'rb') as f, stats.timed('spill read') as timing:
+                result = timing.bytes = f.read()
+            self.spillReads += 1
+        else:
+            with stats.timed('decrypt', os.path.getsize(path)):
+                result = self.fn(path, passw)
+
+        self.cache[name] = result
+        self.size += len(result)
+        # always keep the newest volume, even if it is over the budget alone
+        while self.size > self.maxBytes and len(self.cache) > 1:
+            self.evict()
+        if self.debug:
+            t2 = time.time()
+            print("block cached, volume: %s, bytes: %d necessary time %3.3f, %s" %
+                (name, len(result), round(t2-t,3), self.describe()))
+        return result
+
+    def evict(self):
+        name, data = self.cache.popitem(False)
+        self.size -= len(data)
+        self.evictions += 1
+        stats.count('cache evictions')
+        if self.spillDir:
+            spillPath = os.path.join(self.spillDir, name + '.decrypted')
+            if not os.path.exists(spillPath):
+                # other processes may share the directory, only complete files get the final name
+                tmpPath = '%s.%d.tmp' % (spillPath, os.getpid())
+                with open(tmpPath, 'wb') as f:
+                    f.write(data)
+                os.replace(tmpPath, spillPath)
+
+    def describe(self):
+        return 'hits: %d, misses: %d (%d from spill), evictions: %d, cached: %d volumes, %d bytes' % (
+            self.hits, self.misses, self.spillReads, self.evictions, len(self.cache), self.size)
 
-    memoize_wrapper._limit = cachesize
-    memoize_wrapper._cache = cache
-    return memoize_wrapper
+class RestoreJournal(object):
+    # the files restored so far, kept in the index database so that --resume
+    # can skip them. a file counts as done while it still has the size and
+    # mtime it had after restoring. entries are committed in batches, an
+    # interruption costs at most the last batch. it is also where a file with
+    # the same content is looked up to clone it, instead of a dict in memory.
+    def __init__(self, db, resume, batchSize=200):
+        self.db = db
+        self.batchSize = batchSize
+        self.pending = []
+        self.skipped = 0
+        db.execute('''CREATE TABLE IF NOT EXISTS RestoreJournal (OutPath TEXT PRIMARY KEY,
+            Hash TEXT, Size INTEGER, MTime INTEGER, Verify TEXT) WITHOUT ROWID''')
+        db.execute('''CREATE INDEX IF NOT EXISTS IxRestoreJournalHash ON RestoreJournal(Hash)''')
+        if not resume:
+            db.execute('''DELETE FROM RestoreJournal''')
+        db.commit()
+
+    def isComplete(self, item, outPath):
+        row = self.db.execute('''SELECT Hash, Size, MTime FROM RestoreJournal WHERE OutPath=?''',
+            [outPath]).fetchone()
+        if row is None or row[0] != item['hash'] or row[1] != item['size']:
+            return False
+        try:
+            st = os.stat(outPath)
+        except OSError:
+            return False
+        return st.st_size == row[1] and st.st_mtime_ns == row[2]
+
+    def skipCompleted(self, tasks):
+        for item, outPath in tasks:
+            if self.isComplete(item, outPath):
+                self.skipped += 1
+                stats.count('skipped')
+                continue
+            yield item, outPath
+
+    def findContent(self, item, minSize):
+        # the path of a restored file with the content of item, or None
+        if item['size'] < minSize:
+            return None
+        rows = itertools.chain([row for row in reversed(self.pending) if row[1] == item['hash']],
+            self.db.execute('''SELECT OutPath, Hash, Size, MTime FROM RestoreJournal WHERE Hash=?''',
+                [item['hash']]))
+        for row in rows:
+            try:
+                st = os.stat(row[0])
+            except OSError:
+                continue
+            # not changed since it was restored
+            if st.st_size == row[2] and st.st_mtime_ns == row[3]:
+                return row[0]
+        return None
+
+    def record(self, item, outPath, verify):
+        # call once the file and its metadata are restored
+        st = os.stat(outPath)
+        self.pending.append((outPath, item['hash'], item['size'], st.st_mtime_ns, verify))
+        if len(self.pending) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.db.executemany('''INSERT OR REPLACE INTO RestoreJournal (OutPath, Hash, Size, MTime, Verify)
+                VALUES (?, ?, ?, ?, ?)''', self.pending)
+            self.db.commit()
+            self.pending = []
+
+class RestoreStats(object):
+    # calls, seconds and bytes per phase of the restore, plus counters.
+    # phases can contain each other, a block fetch includes its decrypt.
+    # threads of --pipeline add to it at the same time.
+    def __init__(self):
+        self.started = time.time()
+        self.progressInterval = 0
+        self.lastProgress = self.started
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.counters = {}
+
+    def add(self, phase, seconds, nbytes=0, calls=1):
+        with self.lock:
+            entry = self.phases.get(phase)
+            if entry is None:
+                entry = self.phases[phase] = [0, 0.0, 0]
+            entry[0] += calls
+            entry[1] += seconds
+            entry[2] += nbytes
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def timed(self, phase, nbytes=0):
+        # the block can set .bytes on the yielded object when the size is
+        # only known at the end, as len() of it
+        timing = PhaseTiming(nbytes)
+        t = time.perf_counter()
+        yield timing
+        nbytes = timing.bytes if isinstance(timing.bytes, int) else len(timing.bytes)
+        self.add(phase, time.perf_counter() - t, nbytes)
+
+    def timedIter(self, phase, items):
+        # the time spent producing the items, not in processing them
+        it = iter(items)
+        while True:
+            t = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.add(phase, time.perf_counter() - t, calls=0)
+                return
+            self.add(phase, time.perf_counter() - t)
+            yield item
+
+    def take(self):
+        # returns what was counted so far, and starts over
+        with self.lock:
+            taken = {'phases': self.phases, 'counters': self.counters}
+            self.reset()
+        return taken
+
+    def merge(self, taken):
+        for phase, (calls, seconds, nbytes) in taken['phases'].items():
+            self.add(phase, seconds, nbytes, calls)
+        for name, n in taken['counters'].items():
+            self.count(name, n)
+
+    def showProgress(self):
+        if self.progressInterval and time.time() - self.lastProgress >= self.progressInterval:
+            self.lastProgress = time.time()
+            print('\n' + self.progressLine())
+
+    def progressLine(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        written = self.phases.get('write', [0, 0.0, 0])[2]
+        hits, misses = self.counters.get('cache hits', 0), self.counters.get('cache misses', 0)
+        return '%.0f s: %d files, %d blocks, %.1f MB written, %.1f MB/s, %.0f blocks/s, cache hits %s' % (
+            elapsed, self.counters.get('files', 0), self.counters.get('blocks', 0), written / 1048576.0,
+            written / 1048576.0 / elapsed, self.counters.get('blocks', 0) / elapsed,
+            '%.0f%%' % (100.0 * hits / (hits + misses)) if hits + misses else '-')
+
+    def report(self):
+        elapsed = time.time() - self.started
+        phases = {}
+        for phase, (calls, seconds, nbytes) in self.phases.items():
+            phases[phase] = {'calls': calls, 'seconds': round(seconds, 6), 'bytes': nbytes,
+                'bytes_per_second': round(nbytes / seconds) if seconds and nbytes else None,
+                'share_of_elapsed': round(seconds / elapsed, 4) if elapsed else None}
+        hits, misses = self.counters.get('cache hits', 0), self.counters.get('cache misses', 0)
+        written = self.phases.get('write', [0, 0.0, 0])[2]
+        return {'elapsed_seconds': round(elapsed, 3), 'phases': phases, 'counters': dict(self.counters),
+            'files_per_second': self.counters.get('files', 0) / elapsed if elapsed else None,
+            'blocks_per_second': self.counters.get('blocks', 0) / elapsed if elapsed else None,
+            'bytes_written_per_second': written / elapsed if elapsed else None,
+            'cache_hit_ratio': float(hits) / (hits + misses) if hits + misses else None}
+
+class PhaseTiming(object):
+    def __init__(self, nbytes):
+        self.bytes = nbytes
+
+stats = RestoreStats()
 
 def getHasherObject(hashalg):
     hashalg = hashalg.lower()
@@ -372,21 +1606,27 @@ def getHasherObject(hashalg):
     elif hashalg == 'sha512': return hashlib.sha512
     else: assertTrue(False, 'unknown hash algorithm %s' % hashalg)
 
-def getArchiveOptions(d, dlist):
-    opts = {}
+def readManifest(d, dlist):
+    # returns the text of the manifest in the dlist
     convertStreamToUtf8 = codecs.getreader('utf-8-sig')
     with zipfile.ZipFile(os.path.join(d, dlist), 'r') as z:
         with z.open('manifest', 'r') as zipentry:
             with convertStreamToUtf8(zipentry) as zipentryutf8:
-                alljson = zipentryutf8.read()
-                manifest = json.loads(alljson)
-                assertEqual(manifest['BlockHash'], manifest['FileHash'],
-                    'script currently needs same hash method for blockhash and filehash')
-                opts['blocksize'] = int(manifest['Blocksize'])
-                opts['block-hasher'] = getHasherObject(manifest['BlockHash'])
-                opts['file-hasher'] = getHasherObject(manifest['FileHash'])
-                opts['hash-size'] = opts['block-hasher']().digest_size
-                opts['hashes-per-block'] = opts['blocksize'] // opts['hash-size']
+                return zipentryutf8.read()
+
+def getArchiveOptions(alljson):
+    opts = {}
+    manifest = json.loads(alljson)
+    assertEqual(manifest['BlockHash'], manifest['FileHash'],
+        'script currently needs same hash method for blockhash and filehash')
+    opts['blocksize'] = int(manifest['Blocksize'])
+    opts['block-hasher'] = getHasherObject(manifest['BlockHash'])
+    opts['file-hasher'] = getHasherObject(manifest['FileHash'])
+    opts['hash-size'] = opts['block-hasher']().digest_size
+    opts['hashes-per-block'] = opts['blocksize'] // opts['hash-size']
+    # a full block of zeros is recognised by its hash, without reading it
+    opts['zero-block-hash'] = base64.b64encode(
+        opts['block-hasher'](bytes(opts['blocksize'])).digest()).decode('utf8')
     return opts
 
 def parse_options():
@@ -431,10 +1671,115 @@ def parse_options():
         help="maximum cache size in MB (increase for faster restores, at the cost of higher RAM usage)",
     )
 
+    parser.add_argument(
+        "--dindex",
+        action="store_true",
+        help="build the block index from the small dindex files, only dblock files without a matching dindex are read",
+    )
+
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="plan the restore first, then open every dblock file only once and write its blocks to all files using them. "
+            "planning reads the blocklists of large files, with --dindex from the dindex files, "
+            "else from their dblock files, which may then be decrypted once more",
+    )
+
+    parser.add_argument(
+        "--pipeline",
+        metavar="<threads>",
+        type=int,
+        default=0,
+        help="with --plan, read, decrypt, unzip and write dblock files at the same time, "
+            "using this many threads each for decrypting and unzipping (implies --plan)",
+    )
+
+    parser.add_argument(
+        "--spill-directory",
+        metavar="<spill directory>",
+        help="write decrypted dblocks evicted from the cache to a temporary folder in this directory, "
+            "so they are read back instead of decrypted again (needs up to the size of the backup)",
+    )
+
+    parser.add_argument(
+        "--verify",
+        choices=["none", "blocks", "file"],
+        default="file",
+        help="check the hash of every restored file (default), of every block as it is read, or only the file sizes",
+    )
+
+    parser.add_argument(
+        "--json-parser",
+        choices=["json", "ijson"],
+        default="json",
+        help="parser for the file list: the C scanner of the json module (default), or the pure python lexer of ijson",
+    )
+
+    parser.add_argument(
+        "--version",
+        metavar="<versions>",
+        help="restore these versions instead of the most recent one: 0 is the most recent, "
+            "like 0,3,5 or all. several versions go to subdirectories named by their time",
+    )
+
+    parser.add_argument(
+        "--time",
+        metavar="<time>",
+        help="restore the most recent version made at or before this UTC time, like 2024-01-31T23:59 or 20240131T235959Z",
+    )
+
+    parser.add_argument(
+        "--catalog",
+        action="store_true",
+        help="keep the file list of the dlist in py-restore-catalog.sqlite, so that later runs do not read the dlist again",
+    )
+
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="only print the entries in scope, with their type and size, instead of restoring them",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="<number of processes>",
+        type=int,
+        default=1,
+        help="restore files in parallel using this many processes (the cache size is shared between them), not with --plan",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue an interrupted restore into the same output directory, "
+            "skipping the files it completed (they are recorded in the index database)",
+    )
+
+    parser.add_argument(
+        "--progress",
+        metavar="<seconds>",
+        type=float,
+        default=0,
+        help="print the files and blocks written and the rates every this many seconds, instead of dots",
+    )
+
+    parser.add_argument(
+        "--report",
+        metavar="<file>",
+        help="write the time, calls and bytes of every phase of the restore (index, dlist, decrypt, "
+            "unzip, write, verify, metadata...) and the cache hit ratio to this JSON file",
+    )
+
     parser.add_argument(
         "-d", "--debug", action="store_true", help="more debug output"
     )
     options = parser.parse_args()
+    # combinations where one of the options would be ignored
+    if options.jobs > 1 and (options.plan or options.pipeline):
+        parser.error('--jobs cannot be combined with --plan or --pipeline, --pipeline sets the threads there')
+    if options.version is not None and options.time is not None:
+        parser.error('--version and --time cannot be combined')
     return options
 
 
@@ -478,13 +1823,15 @@ def main():
     if not scope: scope = input('Please type * to restore all files, or a pattern like /path/to/files/* to ' +
         'restore the files in a certain directory)')
     options.scope_directory = scope
-    outdir = options.output_directory
-    if not outdir: outdir = input('Please enter the path to an empty destination directory:')
-    assertTrue(os.path.isdir(outdir), 'Output directory not found')
-    assertTrue(len(os.listdir(outdir)) == 0, 'Output directory not empty')
-    if sys.platform.startswith('win') and len(outdir) > 40:
-        print('note: paths on windows have limited length, you might want to consider a shorter output path.')
-    options.output_directory = outdir
+    if not options.list:
+        outdir = options.output_directory
+        if not outdir: outdir = input('Please enter the path to an empty destination directory:')
+        assertTrue(os.path.isdir(outdir), 'Output directory not found')
+        # with --resume it holds the files of the interrupted run
+        assertTrue(options.resume or len(os.listdir(outdir)) == 0, 'Output directory not empty')
+        if sys.platform.startswith('win') and len(outdir) > 40:
+            print('note: paths on windows have limited length, you might want to consider a shorter output path.')
+        options.output_directory = outdir
 
     # get password
     passw = options.password
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# run with: python3 -m unittest test_ijson
+
+import io
+import json
+import unittest
+
+import ijson
+
+class ChunkedReader(object):
+    # returns at most size characters per read, whatever was asked for
+    def __init__(self, text, size):
+        self.f = io.StringIO(text)
+        self.size = size
+
+    def read(self, n=-1):
+        if n < 0 or n > self.size:
+            n = self.size
+        return self.f.read(n)
+
+class IterArrayItemsTest(unittest.TestCase):
+    def assertItemsAtEveryChunkSize(self, text, **kwargs):
+        want = json.loads(text, parse_float=ijson.number)
+        for use_json in [True, False]:
+            for size in range(1, len(text) + 2):
+                got = list(ijson.iter_array_items(ChunkedReader(text, size), buf_size=size, use_json=use_json, **kwargs))
+                self.assertEqual(want, got, 'use_json=%s, chunk size %d' % (use_json, size))
+
+    def test_numbers(self):
+        self.assertItemsAtEveryChunkSize('[1, 1e5, 1.5, -2.25E-3, 10,123456789012345678901234567890, 0.5e+2,7]')
+
+    def test_objects(self):
+        self.assertItemsAtEveryChunkSize('[{"path": "/a \\u00e9", "size": 1e3, "hash": "x"}, '
+            '{"path": "/b", "blocklists": ["a", "b"], "size": 12.5}, [], {}, "s", true, null, 3]')
+
+    def test_empty(self):
+        self.assertItemsAtEveryChunkSize('[]')
+        self.assertItemsAtEveryChunkSize(' [ ] ')
+
+    def test_truncated_number(self):
+        for use_json in [True, False]:
+            with self.assertRaises(ijson.JSONError):
+                list(ijson.iter_array_items(ChunkedReader('[1, 2.', 1), buf_size=1, use_json=use_json))
+
+if __name__ == '__main__':
+    unittest.main()
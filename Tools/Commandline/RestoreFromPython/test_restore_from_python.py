@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# run with: python3 -m unittest test_restore_from_python
+
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import sqlite3
+import sys
+import unittest
+import zipfile
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+import restore_from_python
+
+BLOCKSIZE = 1024
+
+def makeBackup(d, files, volumes=4):
+    # an unencrypted backup of files {path: data} with one dlist and volumes dblocks
+    blocks = {}
+    def addBlock(data):
+        blockId = base64.b64encode(hashlib.sha256(data).digest()).decode('utf8')
+        blocks[blockId] = data
+        return blockId
+    entries = []
+    for path, data in sorted(files.items()):
+        meta = json.dumps({'CoreLastWritetime': '638400000000000000'}).encode('utf8')
+        entry = {'type': 'File', 'path': path, 'hash': base64.b64encode(hashlib.sha256(data).digest()).decode('utf8'),
+            'size': len(data), 'time': '20240101T000000Z', 'metahash': addBlock(meta), 'metasize': len(meta)}
+        hashes = [hashlib.sha256(data[i:i + BLOCKSIZE]).digest() for i in range(0, len(data), BLOCKSIZE)]
+        for i in range(0, len(data), BLOCKSIZE):
+            addBlock(data[i:i + BLOCKSIZE])
+        if len(hashes) > 1:
+            perList = BLOCKSIZE // 32
+            entry['blocklists'] = [addBlock(b''.join(hashes[i:i + perList])) for i in range(0, len(hashes), perList)]
+        entries.append(entry)
+    manifest = json.dumps({'Version': 2, 'Created': '20240101T000000Z', 'Encoding': 'utf8', 'Blocksize': BLOCKSIZE,
+        'BlockHash': 'SHA256', 'FileHash': 'SHA256', 'AppVersion': '2.0'})
+    blockIds = sorted(blocks)
+    for num in range(volumes):
+        with zipfile.ZipFile(os.path.join(d, 'duplicati-b20240101t000000z%04d.dblock.zip' % num), 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('manifest', manifest)
+            for blockId in blockIds[num::volumes]:
+                z.writestr(blockId.replace('+', '-').replace('/', '_'), blocks[blockId])
+    with zipfile.ZipFile(os.path.join(d, 'duplicati-20240101T000000Z.dlist.zip'), 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('manifest', manifest)
+        z.writestr('filelist.json', json.dumps(entries))
+
+class PlanResumeTest(unittest.TestCase):
+    def setUp(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.backup = os.path.join(tmp.name, 'backup')
+        self.out = os.path.join(tmp.name, 'out')
+        os.mkdir(self.backup)
+        os.mkdir(self.out)
+        rnd = random.Random(1)
+        self.files = dict(('/src/f%d.bin' % i, bytes(rnd.getrandbits(8) for _ in range(rnd.choice([10, 3000, 9000]))))
+            for i in range(12))
+        self.files['/src/copy.bin'] = self.files['/src/f0.bin']
+        makeBackup(self.backup, self.files)
+
+    def restore(self, *args):
+        argv = ['restore_from_python.py', '-b', self.backup, '-o', self.out, '-s', '*'] + list(args)
+        with mock.patch.object(sys, 'argv', argv), mock.patch('sys.stdout', io.StringIO()):
+            restore_from_python.mainRestore(restore_from_python.parse_options())
+
+    def restoreCountingVolumes(self, *args, failAt=None):
+        # returns the number of dblocks written, raises KeyboardInterrupt at dblock failAt
+        written = []
+        writePlanBlocks = restore_from_python.writePlanBlocks
+        def counting(db, name, *rest):
+            if len(written) == failAt:
+                raise KeyboardInterrupt()
+            written.append(name)
+            return writePlanBlocks(db, name, *rest)
+        with mock.patch.object(restore_from_python, 'writePlanBlocks', counting):
+            self.restore(*args)
+        return len(written)
+
+    def assertRestored(self):
+        for path, data in self.files.items():
+            with open(self.out + path, 'rb') as f:
+                self.assertEqual(data, f.read(), path)
+
+    def assertResumes(self, *args):
+        with self.assertRaises(KeyboardInterrupt):
+            self.restoreCountingVolumes(*args, failAt=2)
+        db = sqlite3.connect(os.path.join(self.backup, 'py-restore-index.sqlite'))
+        done = db.execute('SELECT COUNT(*) FROM RestorePlanDone').fetchone()[0]
+        total = db.execute('SELECT COUNT(DISTINCT FileNum) FROM RestorePlanBlock').fetchone()[0]
+        db.close()
+        self.assertEqual(2, done)
+        self.assertEqual(total - done, self.restoreCountingVolumes('--resume', *args))
+        self.assertRestored()
+        # everything is done now
+        self.assertEqual(0, self.restoreCountingVolumes('--resume', *args))
+        self.assertRestored()
+
+    def test_plan_resume(self):
+        self.assertResumes('--plan')
+
+    def test_pipeline_resume(self):
+        self.assertResumes('--pipeline', '2')
+
+    def test_plan_without_resume_starts_over(self):
+        with self.assertRaises(KeyboardInterrupt):
+            self.restoreCountingVolumes('--plan', failAt=2)
+        self.assertEqual(4, self.restoreCountingVolumes('--plan'))
+        self.assertRestored()
+
+if __name__ == '__main__':
+    unittest.main()